@@ -0,0 +1,38 @@
+"""Added meme similar_to
+
+Revision ID: 5d2c8e1f7a63
+Revises: 1b7f3e5a9d24
+Create Date: 2026-10-19 10:14:36.207715
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database.models import COUNTER_TRIGGERS
+
+# revision identifiers, used by Alembic.
+revision = '5d2c8e1f7a63'
+down_revision = '1b7f3e5a9d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Plain ALTER TABLE, rebuilding meme in batch mode breaks counter triggers
+    # on it. Alembic refuses to add the foreign key to an existing SQLite
+    # table, though the column may declare it inline
+    op.execute('ALTER TABLE meme ADD COLUMN similar_to INTEGER REFERENCES meme (id)')
+    op.create_index('ix_meme_similar_to', 'meme', ['similar_to'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_meme_similar_to', table_name='meme')
+    # Column with a foreign key can only be dropped by rebuilding meme,
+    # triggers referring to it are recreated afterwards
+    for name in ('tr_meme_insert_n_pictures', 'tr_meme_delete_n_pictures',
+                 'tr_crop_insert_n_crops', 'tr_crop_delete_n_crops'):
+        op.execute(f'DROP TRIGGER IF EXISTS {name}')
+    with op.batch_alter_table('meme') as batch_op:
+        batch_op.drop_column('similar_to')
+    for triggers in COUNTER_TRIGGERS.values():
+        for trigger in triggers:
+            op.execute(trigger.statement)
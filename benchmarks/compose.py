@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+'''Compares per-composition latency of PIL pasting and the NumPy Compositor.
+
+Bases and crops are random pictures, so no database is needed. Each path
+starts from pictures decoded the way it caches them, PIL images or pixel
+arrays, and returns PIL images like Mixer.compose.
+
+Usage:
+    python -m benchmarks.compose --repeat 200 --crops 3 --base-size 800x800
+    python -m benchmarks.compose --fit cover --feather 4
+    python -m benchmarks.compose --no-opencv
+'''
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from typing import List, Tuple
+from mixer.compositor import Box, Compositor, to_array, to_image
+
+
+def make_mix(rng: np.random.Generator, base_size: Tuple[int, int], n_crops: int):
+    w, h = base_size
+    base = Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+    crops, boxes = [], []
+    for _ in range(n_crops):
+        cw, ch = rng.integers(w // 8, w // 2), rng.integers(h // 16, h // 4)
+        crops.append(Image.fromarray(rng.integers(0, 256, (ch, cw, 3), dtype=np.uint8)))
+        bw, bh = rng.integers(w // 8, w // 2), rng.integers(h // 16, h // 4)
+        x, y = rng.integers(0, w - bw), rng.integers(0, h - bh)
+        boxes.append((int(x), int(y), int(x + bw), int(y + bh)))
+    return base, crops, boxes
+
+
+def compose_pil(base: Image.Image, crops: List[Image.Image], boxes: List[Box]) -> Image.Image:
+    out = base.copy()
+    for crop, (x1, y1, x2, y2) in zip(crops, boxes):
+        out.paste(crop.resize((x2 - x1, y2 - y1), Image.LANCZOS), (x1, y1, x2, y2))
+    return out
+
+
+def compose_numpy(
+        compositor: Compositor,
+        base: np.ndarray,
+        crops: List[np.ndarray],
+        boxes: List[Box]
+) -> Image.Image:
+    return to_image(compositor.compose(base, crops, boxes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--crops', type=int, default=3)
+    parser.add_argument('--base-size', default='800x800')
+    parser.add_argument('--fit', default='stretch')
+    parser.add_argument('--feather', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-opencv', action='store_true', help='resize with NumPy only')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    base_size = tuple(int(s) for s in args.base_size.split('x'))
+    mixes = [make_mix(rng, base_size, args.crops) for _ in range(args.repeat)]
+    arrays = [(to_array(base), [to_array(c) for c in crops], boxes) for base, crops, boxes in mixes]
+    compositor = Compositor(fit=args.fit, feather=args.feather, use_opencv=not args.no_opencv)
+
+    for name, func, inputs in (
+            ('PIL', compose_pil, mixes),
+            ('Compositor', lambda *mix: compose_numpy(compositor, *mix), arrays),
+    ):
+        # Warm up caches of both paths
+        func(*inputs[0])
+        start = time.perf_counter()
+        for mix in inputs:
+            func(*mix)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {elapsed / len(mixes) * 1e3:.2f} ms per composition')
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+'''Measures insert_posts throughput on a temporary database.
+
+Posts are inserted twice with integer ids the way scrapers parse them,
+the second time nothing may be added, as they are already stored.
+
+Usage:
+    python -m benchmarks.insert_posts --posts 10000 --pics 2
+'''
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+from database.engine import make_engine
+from database.bulk import insert_posts
+from database.models import Base, Public, Post, Meme
+
+
+def make_posts(n_posts: int, n_pics: int, public_id: str):
+    posts, memes = [], []
+    for i in range(n_posts):
+        post = Post(public_id=public_id, id=i + 1, date='2021-01-01 00:00:00')
+        posts.append(post)
+        memes.extend(Meme(post=post, index=j if n_pics > 1 else None, phash=f'{i:016x}')
+                     for j in range(n_pics))
+    return posts, memes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--pics', type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = make_engine(f'sqlite:///{Path(tmp) / "memes.db"}')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add(Public(id='-1', domain='benchmark'))
+        session.commit()
+
+        counts = []
+        for attempt in ('insert', 'reinsert'):
+            posts, memes = make_posts(args.posts, args.pics, '-1')
+            start = time.perf_counter()
+            ids = insert_posts(session, posts, memes)
+            session.commit()
+            elapsed = time.perf_counter() - start
+            counts.append(session.query(func.count(Meme.id)).scalar())
+            print(f'{attempt}: {len(ids)} memes in {elapsed:.2f}s')
+        session.close()
+        engine.dispose()
+
+    if counts[1] != counts[0]:
+        sys.exit(f'Reinserting stored posts added {counts[1] - counts[0]} memes')
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+'''Measures bytes read and queries made per Mixer.get_random_mix call.
+
+Reads are taken from /proc/self/io, so this only runs on Linux. Pages
+read through SQLite mmap aren't counted, so it's best run with mmap off.
+
+Usage:
+    MEMES_DB_PRAGMAS=mmap_size=0 python -m benchmarks.mix_io --calls 50 --exact-pics 1 --max-crops 3
+    MEMES_DB_PRAGMAS=mmap_size=0 python -m benchmarks.mix_io --calls 50 --index
+'''
+import time
+import argparse
+from sqlalchemy import event
+from database.engine import engine
+from mixer.mixer import Mixer
+from mixer.mixindex import MixIndex
+
+
+def read_chars() -> int:
+    with open('/proc/self/io') as f:
+        stats = dict(line.split(': ') for line in f.read().splitlines())
+    return int(stats['rchar'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--exact-pics', type=int, default=1)
+    parser.add_argument('--max-crops', type=int, default=3)
+    parser.add_argument('--index', action='store_true', help='sample mixes from MixIndex')
+    args = parser.parse_args()
+    # Index is loaded before counting starts, as it's loaded once per process
+    index = MixIndex() if args.index else None
+
+    n_queries = 0
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(*_):
+        global n_queries
+        n_queries += 1
+
+    total_read, total_time = 0, 0.
+    for _ in range(args.calls):
+        # Fresh mixer, so nothing is served from the identity map
+        mixer = Mixer(index=index)
+        start, started = read_chars(), time.perf_counter()
+        mixer.get_random_mix(exact_pics=args.exact_pics, max_crops=args.max_crops)
+        total_time += time.perf_counter() - started
+        total_read += read_chars() - start
+        del mixer
+    print(f'{args.calls} calls: {total_read / args.calls / 1e3:.1f} KB read, '
+          f'{n_queries / args.calls:.1f} queries, '
+          f'{total_time / args.calls * 1e3:.1f} ms per call')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+'''Counts queries made to sample, pick and load everything compose reads for a mix.
+
+Exits with an error if a mix takes more queries than allowed or loads
+pictures of crops that weren't picked, so lazy loads and eager loads of
+unneeded columns creeping back into the mixer are caught.
+
+Usage:
+    python -m benchmarks.mix_queries --calls 20 --max-queries 5
+    python -m benchmarks.mix_queries --calls 20 --max-queries 2 --index
+'''
+import sys
+import argparse
+from sqlalchemy import event, inspect
+from database.engine import engine
+from mixer.mixer import Mixer
+from mixer.mixindex import MixIndex
+from database.models import Crop
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20)
+    parser.add_argument('--exact-pics', type=int, default=1)
+    parser.add_argument('--max-crops', type=int, default=3)
+    parser.add_argument('--how', default='firstonly')
+    parser.add_argument('--max-queries', type=int, default=5)
+    parser.add_argument('--index', action='store_true', help='sample mixes from MixIndex')
+    args = parser.parse_args()
+    index = MixIndex() if args.index else None
+
+    n_queries = 0
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(*_):
+        global n_queries
+        n_queries += 1
+
+    counts = []
+    for _ in range(args.calls):
+        # Fresh mixer, so nothing is served from the identity map
+        mixer = Mixer(index=index)
+        start = n_queries
+        base_post, posts = mixer.get_random_mix(exact_pics=args.exact_pics, max_crops=args.max_crops)
+        base_post, crops = mixer.pick_crops(base_post, posts, how=args.how)
+        mixer._prefetch(base_post, crops)
+        counts.append(n_queries - start)
+        picked = {c.id for picture_crops in crops for c in picture_crops}
+        loaded = {o.id for o in mixer._session.identity_map.values()
+                  if isinstance(o, Crop) and 'picture' not in inspect(o).unloaded}
+        if loaded - picked:
+            sys.exit(f'Pictures of {len(loaded - picked)} crops that weren\'t picked were loaded')
+        del mixer
+    print(f'{args.calls} calls: {sum(counts) / args.calls:.1f} queries per mix, max {max(counts)}')
+    if max(counts) > args.max_queries:
+        sys.exit(f'Mix took {max(counts)} queries, at most {args.max_queries} are allowed')
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+'''Compares per-image and batched OCR throughput of Cropper.
+
+Usage:
+    python -m benchmarks.ocr_batching --images 'pics/*.jpg' --repeat 8 --batch-size 8
+'''
+import time
+import argparse
+from glob import glob
+from PIL import Image
+from ocr.cropper import Cropper
+
+
+def bench_single(cropper: Cropper, imgs) -> int:
+    return sum(len(cropper._read_bounds(img)) for img in imgs)
+
+
+def bench_batched(cropper: Cropper, imgs, batch_size: int) -> int:
+    return sum(map(len, cropper._read_bounds_batched(imgs, batch_size=batch_size)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default='pics/*.jpg')
+    parser.add_argument('--repeat', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=8)
+    args = parser.parse_args()
+
+    imgs = [Image.open(f).convert('RGB') for f in sorted(glob(args.images))] * args.repeat
+    cropper = Cropper()
+    # Warm up model
+    cropper._read_bounds(imgs[0])
+
+    for name, func in (
+            ('per-image', lambda: bench_single(cropper, imgs)),
+            ('batched', lambda: bench_batched(cropper, imgs, args.batch_size)),
+    ):
+        start = time.perf_counter()
+        n_bounds = func()
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {len(imgs)} images, {n_bounds} bounds in {elapsed:.2f}s '
+              f'({len(imgs) / elapsed:.2f} images/s, {n_bounds / elapsed:.2f} bounds/s)')
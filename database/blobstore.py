@@ -0,0 +1,111 @@
+import os
+import mmap
+import hashlib
+import tempfile
+from io import BytesIO
+from pathlib import Path
+import time
+from typing import BinaryIO, Iterable, Iterator, Union
+
+
+def content_hash(data: bytes) -> str:
+    '''Returns key pictures are stored by'''
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    '''Stores pictures by hash of their content'''
+
+    def put(self, data: bytes) -> str:
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def open(self, key: str) -> BinaryIO:
+        '''Returns a file object to read blob from without copying it'''
+        return BytesIO(self.get(key))
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def keys(self, older_than: float = 0) -> Iterator[str]:
+        '''Iterates over keys of blobs last put at least `older_than` seconds ago'''
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    '''Keeps blobs as files under directories sharded by hash prefix'''
+
+    def __init__(self, root: Union[str, Path] = 'blobs', depth: int = 2):
+        self._root = Path(root)
+        self._depth = depth
+
+    def _path(self, key: str) -> Path:
+        # `ab/cd/abcd...` keeps directories small
+        shards = [key[2 * i:2 * i + 2] for i in range(self._depth)]
+        return self._root.joinpath(*shards, key)
+
+    def put(self, data: bytes) -> str:
+        key = content_hash(data)
+        path = self._path(key)
+        # Same content is stored once, its age is renewed, so garbage
+        # collection never removes blobs of rows that are about to be saved
+        if path.exists():
+            os.utime(path)
+            return key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so readers never see partial blobs
+        fd, tmp = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return key
+
+    def get(self, key: str) -> bytes:
+        return self._path(key).read_bytes()
+
+    def open(self, key: str) -> BinaryIO:
+        with open(self._path(key), 'rb') as f:
+            # Empty files can't be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                return BytesIO()
+            # Mapping stays valid after the file is closed
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+    def keys(self, older_than: float = 0) -> Iterator[str]:
+        deadline = time.time() - older_than
+        # Temporary files of unfinished puts aren't named by hash
+        for path in self._root.glob('/'.join(['*'] * (self._depth + 1))):
+            if len(path.name) == 64 and path.stat().st_mtime <= deadline:
+                yield path.name
+
+
+_store: BlobStore = FileBlobStore(os.environ.get('MEMES_BLOB_DIR', 'blobs'))
+
+
+def get_blob_store() -> BlobStore:
+    return _store
+
+
+def set_blob_store(store: BlobStore) -> None:
+    '''Replaces blob store used by models'''
+    global _store
+    _store = store
+
+
+def store_pictures(objs: Iterable) -> None:
+    '''Moves pictures of not yet saved objects into the blob store'''
+    for obj in objs:
+        if obj.picture is not None:
+            obj.picture_hash = _store.put(obj.picture)
+            obj.picture = None
@@ -0,0 +1,101 @@
+from sqlalchemy import and_, func, insert, or_, update
+from sqlalchemy.orm import Session as SessionType
+from typing import Dict, List, Set, Tuple
+from database.models import Post, Meme, Crop, GeneratedPost, GeneratedMeme, GeneratedCrop
+
+
+# Keeps number of bound parameters under SQLite limit
+IN_CHUNK_SIZE = 400
+
+
+def _to_row(obj, table) -> Dict:
+    # Instance dict skips attribute instrumentation of never flushed objects
+    state = obj.__dict__
+    row = {}
+    for c in table.columns:
+        value = state.get(c.key)
+        # Defaults of ORM columns aren't applied to objects that never get flushed
+        if value is None and c.default is not None and c.default.is_scalar:
+            value = c.default.arg
+        row[c.key] = value
+    return row
+
+
+def _post_key(post: Post) -> Tuple[str, str]:
+    # Scraped ids are ints, stored ones are read back as text
+    return str(post.public_id), str(post.id)
+
+
+def _find_posts_with_memes(session: SessionType, keys: Set[Tuple]) -> Set[Tuple]:
+    # SQLite scans tables for row value IN lists, OR of keys uses the index instead
+    keys = list(keys)
+    stored = set()
+    for i in range(0, len(keys), IN_CHUNK_SIZE):
+        stored.update(session.query(Meme.public_id, Meme.post_id)
+                             .filter(or_(*[and_(Meme.public_id == public_id, Meme.post_id == post_id)
+                                           for public_id, post_id in keys[i:i + IN_CHUNK_SIZE]]))
+                             .distinct()
+                             .all())
+    return stored
+
+
+def _lock_for_write(session: SessionType, model) -> None:
+    # Any write takes SQLite write lock until commit, like BEGIN IMMEDIATE
+    session.execute(update(model.__table__).where(False).values(id=model.__table__.c.id))
+
+
+def _assign_ids(session: SessionType, model, objs: List) -> None:
+    # Ids are assigned up front, rowids of executemany inserts are unknown.
+    # Other writers can't insert rows between reading max id and inserting
+    # while the write lock is held
+    if not objs:
+        return
+    _lock_for_write(session, model)
+    last_id = session.query(func.max(model.id)).scalar() or 0
+    for i, obj in enumerate(objs):
+        obj.id = last_id + i + 1
+
+
+def insert_posts(session: SessionType, posts: List[Post], memes: List[Meme]) -> List[int]:
+    '''Inserts posts skipping already stored ones along with their memes, returns meme ids'''
+    if posts:
+        session.execute(
+            insert(Post.__table__).prefix_with('OR IGNORE'),
+            [_to_row(p, Post.__table__) for p in posts]
+        )
+    if not memes:
+        return []
+    # Insert above holds the write lock, so stored posts and ids can't change until commit
+    stored = _find_posts_with_memes(session, {_post_key(m.post) for m in memes})
+    memes = [m for m in memes if _post_key(m.post) not in stored]
+    if not memes:
+        return []
+    _assign_ids(session, Meme, memes)
+    rows = []
+    for meme in memes:
+        row = _to_row(meme, Meme.__table__)
+        public_id, post_id = _post_key(meme.post)
+        row.update(public_id=public_id, post_id=post_id)
+        rows.append(row)
+    session.execute(insert(Meme.__table__), rows)
+    return [m.id for m in memes]
+
+
+def insert_crops(session: SessionType, crops: List[Crop]) -> None:
+    if crops:
+        session.execute(insert(Crop.__table__), [_to_row(c, Crop.__table__) for c in crops])
+
+
+def insert_generated(session: SessionType, posts: List[GeneratedPost]) -> None:
+    '''Inserts generated posts along with their pictures and crops'''
+    memes = [m for p in posts for m in p.pictures]
+    crops = [c for m in memes for c in m.crops]
+    for model, objs in ((GeneratedPost, posts), (GeneratedMeme, memes), (GeneratedCrop, crops)):
+        _assign_ids(session, model, objs)
+    for meme in memes:
+        meme.generated_post_id = meme.post.id
+    for crop in crops:
+        crop.generated_meme_id = crop.base.id
+    for model, objs in ((GeneratedPost, posts), (GeneratedMeme, memes), (GeneratedCrop, crops)):
+        if objs:
+            session.execute(insert(model.__table__), [_to_row(o, model.__table__) for o in objs])
@@ -1,7 +1,75 @@
-from sqlalchemy import create_engine
+from os import environ
+from typing import Dict, Union
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import Pool, QueuePool
 
-engine = create_engine('sqlite:///memes.db', echo=False, connect_args={"check_same_thread": False})
+Pragmas = Dict[str, Union[int, str]]
+
+DATABASE_URL = environ.get('MEMES_DB_URL', 'sqlite:///memes.db')
+
+SQLITE_PRAGMAS: Pragmas = {
+    # Readers don't block the writer and the other way around
+    'journal_mode': 'WAL',
+    # WAL stays consistent with NORMAL, only fsyncs on checkpoints
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 2 ** 20,
+    # Negative size is in KiB
+    'cache_size': -64 * 2 ** 10,
+    'temp_store': 'MEMORY',
+    # Wait for other writers instead of failing with `database is locked`
+    'busy_timeout': 30000,
+}
+
+
+def parse_pragmas(pragmas: str) -> Pragmas:
+    '''Parses pragmas given as `name=value,name=value`'''
+    pairs = [p.split('=', 1) for p in pragmas.split(',') if p.strip()]
+    return {k.strip(): v.strip() for k, v in pairs}
+
+
+def make_engine(
+        url: str = DATABASE_URL,
+        pragmas: Pragmas = None,
+        poolclass: Pool = QueuePool,
+        pool_size: int = 8,
+        echo: bool = False,
+) -> Engine:
+    '''Creates engine with pragmas applied to every new SQLite connection'''
+    if not url.startswith('sqlite'):
+        return create_engine(url, echo=echo, poolclass=poolclass)
+    pragmas = {**SQLITE_PRAGMAS, **(pragmas or {})}
+    pool_params = {'pool_size': pool_size, 'max_overflow': 2 * pool_size} \
+        if poolclass is QueuePool else {}
+    engine = create_engine(
+        url,
+        echo=echo,
+        poolclass=poolclass,
+        connect_args={'check_same_thread': False},
+        **pool_params
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return engine
+
+
+engine = make_engine(pragmas=parse_pragmas(environ.get('MEMES_DB_PRAGMAS', '')))
+
+
+def dispose_after_fork() -> None:
+    '''Drops pooled connections inherited by a forked worker process.
+
+    Connections are left open, they're still used by the parent and
+    closing them in the child could release its locks.
+    '''
+    engine.dispose(close=False)
 Base = declarative_base()
 Session = sessionmaker(bind=engine)
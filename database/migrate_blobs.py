@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''Moves pictures stored in the database into the blob store.
+
+Blobs no longer referenced by any row, e.g. of deleted posts or of memes
+skipped as already stored, are removed with --gc.
+
+Usage:
+    python -m database.migrate_blobs --batch-size 500 --vacuum
+    python -m database.migrate_blobs --gc --gc-grace-minutes 60
+'''
+import argparse
+from sqlalchemy import text
+from sqlalchemy.orm import undefer
+from database.engine import Session, engine
+from database.blobstore import store_pictures, get_blob_store
+from database.models import Meme, Crop, GeneratedMeme
+
+
+def migrate(model, batch_size: int = 500) -> int:
+    '''Moves pictures of all rows of model, returns number of moved pictures'''
+    moved = 0
+    while True:
+        # Moved rows drop out of the filter, so the first page is always next
+        with Session() as session:
+            rows = session.query(model) \
+                          .options(undefer(model.picture)) \
+                          .filter(model.picture.isnot(None)) \
+                          .order_by(model.id) \
+                          .limit(batch_size) \
+                          .all()
+            if not rows:
+                return moved
+            store_pictures(rows)
+            session.commit()
+        moved += len(rows)
+        print(f'{model.__tablename__}: {moved} pictures moved')
+
+
+def collect_garbage(grace: float = 3600) -> int:
+    '''Deletes blobs not referenced by any row, returns number of deleted blobs
+
+    Blobs put less than `grace` seconds ago are kept, rows referencing
+    them may not be committed yet.
+    '''
+    store = get_blob_store()
+    # Listed before references are read, so blobs put meanwhile are too new to be deleted
+    keys = list(store.keys(older_than=grace))
+    referenced = set()
+    with Session() as session:
+        for model in (Meme, Crop, GeneratedMeme):
+            referenced.update(h for h, in session.query(model.picture_hash)
+                                                 .filter(model.picture_hash.isnot(None))
+                                                 .distinct())
+    # Blobs put again while references were read are kept too
+    renewed = set(keys) - set(store.keys(older_than=grace))
+    deleted = 0
+    for key in keys:
+        if key not in referenced and key not in renewed:
+            store.delete(key)
+            deleted += 1
+    print(f'{deleted} unreferenced blobs deleted, {len(keys) - deleted} kept')
+    return deleted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--vacuum', action='store_true', help='shrink database file afterwards')
+    parser.add_argument('--gc', action='store_true', help='delete blobs no row refers to')
+    parser.add_argument('--gc-grace-minutes', type=float, default=60)
+    args = parser.parse_args()
+
+    for model in (Meme, Crop, GeneratedMeme):
+        migrate(model, batch_size=args.batch_size)
+    if args.gc:
+        collect_garbage(grace=args.gc_grace_minutes * 60)
+    # Space of moved pictures is only returned to the filesystem by VACUUM
+    if args.vacuum:
+        with engine.connect() as conn:
+            conn.execute(text('VACUUM'))
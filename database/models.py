@@ -1,8 +1,20 @@
 from sqlalchemy import Column, Integer, String, Text, \
-    ForeignKey, ForeignKeyConstraint, desc
+    ForeignKey, ForeignKeyConstraint, Index, DDL, desc, event
 from sqlalchemy.dialects.sqlite import BLOB
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
+from PIL import Image
+from io import BytesIO
+from typing import Tuple, BinaryIO
+import json
 from database.engine import Base, engine
+from database.blobstore import get_blob_store
+
+
+# OCR statuses of memes
+OCR_PENDING = 0
+OCR_DONE = 1
+# Kept instead of deleted to be refiltered later
+OCR_REJECTED = 2
 
 
 class Public(Base):
@@ -10,6 +22,9 @@ class Public(Base):
 
     id = Column(String(15), primary_key=True)
     domain = Column(String(50), nullable=False)
+    # Newest post seen by incremental scraping
+    last_post_id = Column(Integer)
+    last_post_date = Column(String(30))
 
     posts = relationship(
         'Post',
@@ -33,6 +48,8 @@ class Post(Base):
     likes = Column(Integer)
     reposts = Column(Integer)
     views = Column(Integer)
+    # Kept up to date by triggers on meme
+    n_pictures = Column(Integer, nullable=False, default=0, server_default='0')
 
     # public = relationship('Public', backref='posts')
     pictures = relationship(
@@ -47,6 +64,10 @@ class Post(Base):
         cascade='all, delete',
     )
 
+    __table_args__ = (
+        Index('ix_post_n_pictures_public_id_date', 'n_pictures', 'public_id', 'date'),
+    )
+
     def __repr__(self):
         return (f'<Post: id={self.id}, public_id={self.public_id}, '
                 f'date={self.date}, text={self.text}, comments={self.comments}, '
@@ -59,8 +80,27 @@ class Meme(Base):
     id = Column(Integer, primary_key=True)
     public_id = Column(String(15), nullable=False)
     post_id = Column(String(10), nullable=False)
-    picture = Column(BLOB, nullable=False)
+    # Duplicates don't store a picture of their own
+    # Pictures are only loaded on access, so selecting memes stays cheap
+    picture = deferred(Column(BLOB))
+    # Key of the picture in the blob store, replaces `picture`
+    picture_hash = Column(String(64))
     index = Column(Integer)
+    # VK photo id as `{owner_id}_{id}`
+    photo_key = Column(String(40), index=True)
+    # Perceptual hash of the picture
+    phash = Column(String(16), index=True)
+    duplicate_of = Column(Integer, ForeignKey('meme.id'), index=True)
+    # Stored meme with the same perceptual hash but other content,
+    # e.g. the same template with another caption
+    similar_to = Column(Integer, ForeignKey('meme.id'), index=True)
+    # Set once crops are saved, version of the cropper that made them
+    ocr_status = Column(Integer, nullable=False, default=OCR_PENDING, server_default='0')
+    ocr_version = Column(Integer)
+    # Kept up to date by triggers on crop
+    n_crops = Column(Integer, nullable=False, default=0, server_default='0')
+    # Raw OCR detections as JSON list of [box, text(, confidence)]
+    detections = deferred(Column(Text))
 
     # post = relationship('Post', backref='pictures')
     crops = relationship(
@@ -69,23 +109,52 @@ class Meme(Base):
         backref='base',
         cascade='all, delete',
     )
+    source = relationship(
+        'Meme',
+        remote_side=[id],
+        foreign_keys=[duplicate_of],
+        backref='duplicates',
+    )
 
-    __table_args__ = (ForeignKeyConstraint(
-        ['public_id', 'post_id'], ['post.public_id', 'post.id'],
-        # onupdate='CASCADE', ondelete='CASCADE'
-    ), {})
+    def get_picture(self) -> bytes:
+        if self.duplicate_of is not None:
+            return self.source.get_picture()
+        if self.picture_hash is not None:
+            return get_blob_store().get(self.picture_hash)
+        return self.picture
+
+    def open_picture(self) -> BinaryIO:
+        if self.duplicate_of is not None:
+            return self.source.open_picture()
+        if self.picture_hash is not None:
+            return get_blob_store().open(self.picture_hash)
+        return BytesIO(self.picture)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ['public_id', 'post_id'], ['post.public_id', 'post.id'],
+            # onupdate='CASCADE', ondelete='CASCADE'
+        ),
+        Index('ix_meme_ocr_status_id', 'ocr_status', 'id'),
+        Index('ix_meme_ocr_version_id', 'ocr_version', 'id'),
+        # Lookups by post don't scan rows with pictures
+        Index('ix_meme_public_id_post_id', 'public_id', 'post_id'),
+        Index('ix_meme_n_crops_public_id_post_id', 'n_crops', 'public_id', 'post_id'),
+    )
 
     def __repr__(self):
         return (f'<Meme: id={self.id}, public_id={self.public_id}, post_id={self.post_id}, '
-                f'index={self.index}>')
+                f'index={self.index}, duplicate_of={self.duplicate_of}>')
 
 
 class Crop(Base):
     __tablename__ = 'crop'
 
     id = Column(Integer, primary_key=True)
-    meme_id = Column(Integer, ForeignKey('meme.id'))
-    picture = Column(BLOB, nullable=False)
+    meme_id = Column(Integer, ForeignKey('meme.id'), index=True)
+    # Lazy crops don't store a picture, it's cut out of the meme by position
+    picture = deferred(Column(BLOB))
+    picture_hash = Column(String(64))
     position = Column(Text, nullable=False)
     width = Column(Integer, nullable=False)
     height = Column(Integer, nullable=False)
@@ -100,6 +169,29 @@ class Crop(Base):
         cascade='all, delete',
     )
 
+    def get_box(self) -> Tuple[int, int, int, int]:
+        position = json.loads(self.position)
+        (xmin, xmax), (ymin, ymax) = position['x'], position['y']
+        return xmin, ymin, xmax, ymax
+
+    def is_lazy(self) -> bool:
+        return self.picture_hash is None and self.picture is None
+
+    def get_picture(self) -> bytes:
+        if self.picture_hash is not None:
+            return get_blob_store().get(self.picture_hash)
+        if self.picture is not None:
+            return self.picture
+        image = Image.open(self.base.open_picture())
+        buf = BytesIO()
+        image.crop(self.get_box()).save(buf, format='JPEG')
+        return buf.getvalue()
+
+    def open_picture(self) -> BinaryIO:
+        if self.picture_hash is not None:
+            return get_blob_store().open(self.picture_hash)
+        return BytesIO(self.get_picture())
+
     def __repr__(self):
         return (f'<Crop: id={self.id}, meme_id={self.meme_id}, index={self.index}, '
                 f'text={self.text}>')
@@ -130,7 +222,8 @@ class GeneratedMeme(Base):
     __tablename__ = 'generated_meme'
 
     id = Column(Integer, primary_key=True)
-    picture = Column(BLOB, nullable=False)
+    picture = deferred(Column(BLOB))
+    picture_hash = Column(String(64))
     generated_post_id = Column(Integer, ForeignKey('generated_post.id'), nullable=False)
     index = Column(Integer)
 
@@ -141,6 +234,11 @@ class GeneratedMeme(Base):
         cascade='all, delete',
     )
 
+    def get_picture(self) -> bytes:
+        if self.picture_hash is not None:
+            return get_blob_store().get(self.picture_hash)
+        return self.picture
+
 
 class GeneratedCrop(Base):
     __tablename__ = 'generated_crop'
@@ -151,4 +249,34 @@ class GeneratedCrop(Base):
     index = Column(Integer, nullable=False)
 
 
+# Counters are maintained by the database, so bulk inserts keep them right too
+COUNTER_TRIGGERS = {
+    Meme.__table__: [
+        DDL('''CREATE TRIGGER IF NOT EXISTS tr_meme_insert_n_pictures AFTER INSERT ON meme
+        BEGIN
+            UPDATE post SET n_pictures = n_pictures + 1
+            WHERE public_id = NEW.public_id AND id = NEW.post_id;
+        END'''),
+        DDL('''CREATE TRIGGER IF NOT EXISTS tr_meme_delete_n_pictures AFTER DELETE ON meme
+        BEGIN
+            UPDATE post SET n_pictures = n_pictures - 1
+            WHERE public_id = OLD.public_id AND id = OLD.post_id;
+        END'''),
+    ],
+    Crop.__table__: [
+        DDL('''CREATE TRIGGER IF NOT EXISTS tr_crop_insert_n_crops AFTER INSERT ON crop
+        BEGIN
+            UPDATE meme SET n_crops = n_crops + 1 WHERE id = NEW.meme_id;
+        END'''),
+        DDL('''CREATE TRIGGER IF NOT EXISTS tr_crop_delete_n_crops AFTER DELETE ON crop
+        BEGIN
+            UPDATE meme SET n_crops = n_crops - 1 WHERE id = OLD.meme_id;
+        END'''),
+    ],
+}
+for table, triggers in COUNTER_TRIGGERS.items():
+    for trigger in triggers:
+        event.listen(table, 'after_create', trigger.execute_if(dialect='sqlite'))
+
+
 Base.metadata.create_all(engine)
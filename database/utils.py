@@ -22,3 +22,13 @@ def get_public(id: str = None, domain: str = None) -> Public:
             or_(Public.id == id, Public.domain == domain)
         ).one()
     return public
+
+
+def set_last_post(id: str, post_id: int, date: str) -> None:
+    '''Moves high-water mark of public with given id to given post'''
+    with Session() as session:
+        session.query(Public).filter(Public.id == id).update({
+            Public.last_post_id: post_id,
+            Public.last_post_date: date,
+        })
+        session.commit()
@@ -1,5 +1,7 @@
 from mixer.mixer import Mixer
+from mixer.mixindex import MixIndex
 from scraper.parallelscraper import ParallelScraper
+from scraper.asyncscraper import AsyncParallelScraper
 from ocr.cropper import Cropper
 from database.utils import add_public
 from database.models import *
@@ -31,21 +33,19 @@ if __name__ == '__main__':
         'mudakoff': 300,
     }
 
-    # scraper = ParallelScraper()
+    # scraper = AsyncParallelScraper()
     # scraper.scrape(plan)
 
     # cropper = Cropper()
     # cropper.crop()
 
-    for i in range(100):
-        print(f'Mixing {i+1}')
-        mixer = Mixer()
-        base_post, posts = mixer.get_random_mix(
-            include_publics=['memy_pro_kotow'],
-            exact_pics=1,
-            max_crops=3
-        )
-        base_post, crops = mixer.pick_crops(base_post, posts, how='firstonly')
-        memes = mixer.compose(base_post, crops)
-        mixer.save_to_database(base_post, crops, memes)
-        # mixer.save_to_file(memes, f'{i}_test.jpg')
+    index = MixIndex()
+    stats = Mixer(index=index).generate_many(
+        100,
+        how='firstonly',
+        include_publics=['memy_pro_kotow'],
+        exact_pics=1,
+        max_crops=3
+    )
+    print(f'Mixed {stats["n_posts"]} posts ({stats["n_pics"]} pics), '
+          f'skipped {stats["skipped"]} in {stats["seconds"]:.1f}s')
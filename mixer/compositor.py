@@ -0,0 +1,197 @@
+import numpy as np
+from functools import lru_cache
+from typing import List, Tuple
+from PIL import Image
+
+try:
+    # Comes with easyocr and resizes arrays several times faster than NumPy
+    import cv2
+except ImportError:
+    cv2 = None
+
+# (x1, y1, x2, y2) of a region in base picture, like PIL boxes
+Box = Tuple[int, int, int, int]
+FIT_MODES = ('stretch', 'cover', 'contain')
+
+
+def to_array(image: Image.Image) -> np.ndarray:
+    '''Returns read-only RGB pixels of image as a (height, width, 3) array'''
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    array = np.array(image)
+    array.flags.writeable = False
+    return array
+
+
+def to_image(array: np.ndarray) -> Image.Image:
+    '''Returns RGB image sharing memory with the pixels'''
+    h, w = array.shape[:2]
+    return Image.frombuffer('RGB', (w, h), np.ascontiguousarray(array), 'raw', 'RGB', 0, 1)
+
+
+@lru_cache(maxsize=1024)
+def _taps(n: int, size: int, channels: int = 1) -> Tuple[bool, np.ndarray, np.ndarray, np.ndarray]:
+    # Two source indices and a weight per output value, indices of columns
+    # point into rows of (pixel, channel) values
+    if size < n:
+        # Shrinking averages source pixels falling into each output pixel,
+        # indices bound the range in cumulative sums
+        edges = np.arange(size + 1) * n / size
+        i0 = np.floor(edges[:-1]).astype(np.intp)
+        i1 = np.maximum(np.ceil(edges[1:]).astype(np.intp), i0 + 1)
+        w = (1 / (i1 - i0)).astype(np.float32)
+    else:
+        # Enlarging interpolates linearly between centers of source pixels
+        x = np.clip((np.arange(size) + 0.5) * n / size - 0.5, 0, n - 1)
+        i0 = np.floor(x).astype(np.intp)
+        i1 = np.minimum(i0 + 1, n - 1)
+        w = (x - i0).astype(np.float32)
+    if channels > 1:
+        channel = np.arange(channels)
+        i0, i1 = (i0[:, None] * channels + channel).ravel(), (i1[:, None] * channels + channel).ravel()
+        w = np.repeat(w, channels)
+    return size < n, i0, i1, w
+
+
+def _resize_rows(array: np.ndarray, size: int) -> np.ndarray:
+    n = array.shape[0]
+    if n == size:
+        return array
+    area, i0, i1, w = _taps(n, size)
+    w = w[:, None]
+    if area:
+        sums = np.zeros((n + 1, array.shape[1]), dtype=np.float32)
+        np.cumsum(array, axis=0, dtype=np.float32, out=sums[1:])
+        return (sums[i1] - sums[i0]) * w
+    lo = array[i0].astype(np.float32)
+    return lo + (array[i1] - lo) * w
+
+
+def _resize_columns(array: np.ndarray, size: int, channels: int) -> np.ndarray:
+    height, n = array.shape[0], array.shape[1] // channels
+    if n == size:
+        return array
+    area, i0, i1, w = _taps(n, size, channels)
+    if area:
+        sums = np.zeros((height, n + 1, channels), dtype=np.float32)
+        np.cumsum(array.reshape(height, n, channels), axis=1, dtype=np.float32, out=sums[:, 1:])
+        sums = sums.reshape(height, -1)
+        return (sums[:, i1] - sums[:, i0]) * w
+    lo = array[:, i0].astype(np.float32)
+    return lo + (array[:, i1] - lo) * w
+
+
+def resize(array: np.ndarray, size: Tuple[int, int], use_opencv: bool = True) -> np.ndarray:
+    '''Resizes pixels to exactly (width, height), averaging when shrinking and interpolating when enlarging'''
+    w, h = size
+    src_h, src_w, channels = array.shape
+    if (w, h) == (src_w, src_h):
+        return array
+    if use_opencv and cv2 is not None:
+        # Linear interpolation skips source pixels along a shrinking axis and
+        # aliases, so it's only used when both axes grow
+        interpolation = cv2.INTER_AREA if w < src_w or h < src_h else cv2.INTER_LINEAR
+        return cv2.resize(array, (w, h), interpolation=interpolation)
+    # Pixels are viewed as rows of (pixel, channel) values and resized
+    # an axis at a time, the one shrinking more goes first as it leaves
+    # less to the other pass
+    flat = array.reshape(src_h, src_w * channels)
+    if h / src_h < w / src_w:
+        resized = _resize_columns(_resize_rows(flat, h), w, channels)
+    else:
+        resized = _resize_rows(_resize_columns(flat, w, channels), h)
+    return np.clip(np.rint(resized), 0, 255).astype(np.uint8).reshape(h, w, channels)
+
+
+def fit(
+        array: np.ndarray,
+        size: Tuple[int, int],
+        mode: str = 'stretch',
+        use_opencv: bool = True
+) -> Tuple[np.ndarray, int, int]:
+    '''Resizes pixels to fit into (width, height), returns them with their offset in it'''
+    w, h = size
+    src_h, src_w = array.shape[:2]
+    if mode == 'stretch':
+        return resize(array, size, use_opencv), 0, 0
+    if mode == 'cover':
+        # Keeps aspect ratio, overflow is cut off evenly on both sides
+        scale = max(w / src_w, h / src_h)
+        new_w, new_h = max(w, round(src_w * scale)), max(h, round(src_h * scale))
+        x, y = (new_w - w) // 2, (new_h - h) // 2
+        return resize(array, (new_w, new_h), use_opencv)[y:y + h, x:x + w], 0, 0
+    if mode == 'contain':
+        # Keeps aspect ratio, centered in the box
+        scale = min(w / src_w, h / src_h)
+        new_w, new_h = max(1, min(w, round(src_w * scale))), max(1, min(h, round(src_h * scale)))
+        return resize(array, (new_w, new_h), use_opencv), (w - new_w) // 2, (h - new_h) // 2
+    raise ValueError(f'Undefined fit mode {mode}, expected one of {FIT_MODES}')
+
+
+@lru_cache(maxsize=1024)
+def _ramp(n: int, feather: int) -> np.ndarray:
+    # Opacity rising from both ends to 1 over `feather` pixels
+    ramp = np.minimum(np.arange(n), np.arange(n)[::-1]) + 1
+    ramp = np.minimum(ramp / (feather + 1), 1).astype(np.float32)
+    ramp.flags.writeable = False
+    return ramp
+
+
+def feather_mask(height: int, width: int, feather: int) -> np.ndarray:
+    '''Returns opacity rising from the edges to 1 over `feather` pixels'''
+    # Only the 1-D ramps are cached, masks take as much memory as pictures
+    return np.minimum.outer(_ramp(height, feather), _ramp(width, feather))[..., None]
+
+
+class Compositor:
+    '''Pastes crops into boxes of base pictures working on NumPy arrays.
+
+    Crops are resized into their boxes according to `fit` mode and blended
+    over `feather` pixels at the edges. Output only depends on the inputs
+    and on whether OpenCV resizes them.
+    '''
+
+    def __init__(self, fit: str = 'stretch', feather: int = 0, use_opencv: bool = True):
+        if fit not in FIT_MODES:
+            raise ValueError(f'Undefined fit mode {fit}, expected one of {FIT_MODES}')
+        self._fit = fit
+        self._feather = feather
+        self._use_opencv = use_opencv
+
+    def _blit(self, out: np.ndarray, crop: np.ndarray, box: Box) -> None:
+        x1, y1, x2, y2 = box
+        if x2 <= x1 or y2 <= y1:
+            return
+        pixels, dx, dy = fit(crop, (x2 - x1, y2 - y1), self._fit, self._use_opencv)
+        x1, y1 = x1 + dx, y1 + dy
+        h, w = pixels.shape[:2]
+        # Part of the box outside of base picture is dropped
+        top, left = max(0, -y1), max(0, -x1)
+        bottom, right = min(h, out.shape[0] - y1), min(w, out.shape[1] - x1)
+        if bottom <= top or right <= left:
+            return
+        region = out[y1 + top:y1 + bottom, x1 + left:x1 + right]
+        pixels = pixels[top:bottom, left:right]
+        if self._feather > 0:
+            # Mask is only built for the visible part of the crop
+            mask = np.minimum.outer(
+                _ramp(h, self._feather)[top:bottom], _ramp(w, self._feather)[left:right]
+            )[..., None]
+            pixels = np.rint(region * (1 - mask) + pixels * mask).astype(np.uint8)
+        region[...] = pixels
+
+    def compose(self, base: np.ndarray, crops: List[np.ndarray], boxes: List[Box]) -> np.ndarray:
+        '''Returns copy of base with crops pasted into boxes'''
+        out = base.copy()
+        for crop, box in zip(crops, boxes):
+            self._blit(out, crop, box)
+        return out
+
+    def compose_many(
+            self,
+            bases: List[np.ndarray],
+            crops: List[List[np.ndarray]],
+            boxes: List[List[Box]]
+    ) -> List[np.ndarray]:
+        '''Composes each base picture of a post with its crops'''
+        return [self.compose(b, c, bx) for b, c, bx in zip(bases, crops, boxes)]
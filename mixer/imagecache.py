@@ -0,0 +1,97 @@
+from os import environ
+from threading import Lock
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Union
+from PIL.Image import Image
+import numpy as np
+
+StatDict = Dict[str, Union[int, float]]
+Picture = Union[Image, np.ndarray]
+
+
+def _image_size(image: Picture) -> int:
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    # Decoded pictures take a byte per band and pixel in modes memes come in
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageCache:
+    '''LRU cache of decoded pictures limited by the memory they take.
+
+    Pictures are PIL images or pixel arrays. Cached ones are shared,
+    so they must not be modified in place. A picture cached for another
+    version of its key, e.g. of a row that was reprocessed or whose id
+    was reused, is replaced instead of returned.
+    '''
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self._max_bytes = max_bytes
+        self._images: OrderedDict = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._versions: Dict[Hashable, Hashable] = {}
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = Lock()
+
+    def get(self, key: Hashable, load: Callable[[], Picture], version: Hashable = None) -> Picture:
+        '''Returns picture cached for this version of key or loads, caches and returns it'''
+        with self._lock:
+            if key in self._images and self._versions[key] == version:
+                self._hits += 1
+                self._images.move_to_end(key)
+                return self._images[key]
+            self._misses += 1
+        # Decoding isn't locked, threads may rarely decode the same picture twice
+        image = load()
+        if isinstance(image, Image):
+            image.load()
+        self._put(key, image, version)
+        return image
+
+    def _put(self, key: Hashable, image: Picture, version: Hashable = None) -> None:
+        size = _image_size(image)
+        with self._lock:
+            if key in self._images:
+                if self._versions[key] == version:
+                    return
+                self._pop(key)
+            if size > self._max_bytes:
+                return
+            self._images[key] = image
+            self._sizes[key] = size
+            self._versions[key] = version
+            self._size += size
+            while self._size > self._max_bytes:
+                self._pop(next(iter(self._images)))
+                self._evictions += 1
+
+    def _pop(self, key: Hashable) -> None:
+        del self._images[key]
+        del self._versions[key]
+        self._size -= self._sizes.pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._images.clear()
+            self._sizes.clear()
+            self._versions.clear()
+            self._size = 0
+
+    def stats(self) -> StatDict:
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / requests if requests else 0.,
+                'evictions': self._evictions,
+                'items': len(self._images),
+                'size': self._size,
+            }
+
+
+# Shared by mixers in a process, so popular bases and crops are decoded once
+default_image_cache = ImageCache(int(environ.get('MEMES_IMAGE_CACHE_MB', 256)) * 2 ** 20)
@@ -1,30 +1,60 @@
 from sqlalchemy.sql.elements import BinaryExpression as Predicate
 from sqlalchemy.sql.selectable import Subquery
 from sqlalchemy.exc import NoResultFound
-from sqlalchemy import func, and_, or_
+from sqlalchemy import and_, or_, inspect
+from sqlalchemy.orm import Query, aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from PIL.JpegImagePlugin import JpegImageFile as Jpeg
 from PIL import Image
+import numpy as np
 
-from typing import List, Union, Dict, Tuple, Callable
+from typing import List, Union, Dict, Tuple, Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from operator import le, ge, eq, ne
 from io import BytesIO
 from pathlib import Path
 import json
+import time
 
 from database.engine import Session
+from database.blobstore import store_pictures
+from database.bulk import IN_CHUNK_SIZE, insert_generated
+from mixer.sampler import CandidateSampler, default_sampler
+from mixer.mixindex import MixIndex, PostKey
+from mixer.imagecache import ImageCache, default_image_cache
+from mixer.compositor import Compositor, to_array, to_image
 from database.models import GeneratedPost, GeneratedMeme, GeneratedCrop, \
-        Public, Post, Meme, Crop
+        Public, Post, Meme, Crop, OCR_DONE
 
 Operator = Union[le, ge, eq, ne]
 Subqueries = Union[Subquery, List[Subquery]]
 JsonDict = Dict[str, int]
-BaseJpegs, CropJpegs, PositionJsonDicts = List[Jpeg], List[List[Jpeg]], List[List[JsonDict]]
+StatDict = Dict[str, Union[int, float]]
+BasePixels, CropPixels, PositionJsonDicts = List[np.ndarray], List[List[np.ndarray]], List[List[JsonDict]]
+
+# Loads pictures and their crops along with posts in one query, crop
+# pictures stay deferred and are only loaded for picked crops
+MIX_LOAD_OPTIONS = (
+    joinedload(Post.pictures).joinedload(Meme.crops),
+)
 
 
 class Mixer:
 
-    def __init__(self):
+    def __init__(
+            self,
+            image_cache: ImageCache = None,
+            sampler: CandidateSampler = None,
+            index: MixIndex = None,
+            compositor: Compositor = None,
+    ):
         self._session = Session()
+        self._sampler = sampler if sampler is not None else default_sampler
+        # Mixes are sampled from index instead of queries if it's given
+        self._index = index
+        # Decoded pixels, shared by mixers unless a cache is given
+        self._images = image_cache if image_cache is not None else default_image_cache
+        self._compositor = compositor if compositor is not None else Compositor()
 
     def __del__(self):
         self._session.close()
@@ -34,37 +64,50 @@ class Mixer:
         image.save(buf, format='JPEG')
         return buf.getvalue()
 
-    def _get_image(self, obj: Union[Meme, Crop]) -> Jpeg:
-        return Image.open(BytesIO(obj.picture))
+    def _get_meme_image(self, meme: Meme) -> np.ndarray:
+        # Duplicates share the picture of their original
+        if meme.duplicate_of is not None:
+            meme = meme.source
+        load = lambda: to_array(Image.open(meme.open_picture()))
+        # Blobs are addressed by their content, so their pixels never go stale
+        if meme.picture_hash is not None:
+            return self._images.get(('blob', meme.picture_hash), load)
+        # Ids of deleted memes may be reused, perceptual hash tells their pictures apart
+        return self._images.get(('meme', meme.id), load, version=meme.phash)
+
+    def _get_image(self, obj: Union[Meme, Crop]) -> np.ndarray:
+        if isinstance(obj, Meme):
+            return self._get_meme_image(obj)
+        # Lazy crops are views of their meme pixels, so they take no memory of their own
+        if obj.is_lazy():
+            x1, y1, x2, y2 = obj.get_box()
+            return self._get_meme_image(obj.base)[y1:y2, x1:x2]
+        load = lambda: to_array(Image.open(obj.open_picture()))
+        if obj.picture_hash is not None:
+            return self._images.get(('blob', obj.picture_hash), load)
+        # Recropping replaces crops of a meme and may give their ids to others
+        return self._images.get(('crop', obj.id), load, version=(obj.meme_id, obj.base.ocr_version))
 
     def _get_json(self, json_string: str) -> JsonDict:
         return json.loads(json_string)
 
-    def _count_crops(self, meme: Meme) -> int:
-        return self._session.query(Meme)\
-                             .join(Crop) \
-                             .filter(Meme.post_id == meme.post_id) \
-                             .count()
-
     def _n_pics_filter(self, n_pics: int = 1, op: Operator = eq) -> Subquery:
+        # Posts without pictures never matched the former group by meme
         return self._session.query(
             Post.public_id,
             Post.id
         ) \
-         .join(Meme) \
-         .group_by(Meme.post_id) \
-         .having(op(func.count(Meme.id), n_pics)) \
+         .filter(Post.n_pictures > 0, op(Post.n_pictures, n_pics)) \
          .subquery()
 
     def _n_crops_filter(self, n_crops: int = 1, op: Operator = eq) -> Subquery:
+        # Row for each cropped meme with given number of crops, like the
+        # former group by meme, plain rows let SQLite flatten the join
         return self._session.query(
-            Post.public_id,
-            Post.id
+            Meme.public_id.label('public_id'),
+            Meme.post_id.label('id')
         ) \
-         .join(Meme) \
-         .join(Crop) \
-         .group_by(Crop.meme_id) \
-         .having(op(func.count(Crop.id), n_crops)) \
+         .filter(Meme.n_crops > 0, op(Meme.n_crops, n_crops)) \
          .subquery()
 
     def _get_random_post(
@@ -73,14 +116,48 @@ class Mixer:
         post_predicate: Predicate = None,
         meme_predicate: Predicate = None,
         crop_predicate: Predicate = None,
-        subquery_filters: Subqueries = []
+        subquery_filters: Subqueries = [],
+        exclude_post_id: str = None,
     ) -> Post:
+        q = self._get_posts_query(
+            public_predicate, post_predicate, meme_predicate, crop_predicate, subquery_filters
+        )
+        return self._sampler.sample(self._session, Post, q, exclude=self._exclude_post(exclude_post_id))
+
+    def _get_random_post_key(
+        self,
+        public_predicate: Predicate = None,
+        post_predicate: Predicate = None,
+        meme_predicate: Predicate = None,
+        crop_predicate: Predicate = None,
+        subquery_filters: Subqueries = [],
+        exclude_post_id: str = None,
+    ) -> PostKey:
+        q = self._get_posts_query(
+            public_predicate, post_predicate, meme_predicate, crop_predicate, subquery_filters
+        )
+        return self._sampler.sample_key(Post, q, exclude=self._exclude_post(exclude_post_id))
+
+    def _exclude_post(self, post_id: str = None) -> Union[Callable[[PostKey], bool], None]:
+        # Excluded post is rejected, so candidates are shared between base posts
+        if post_id is None:
+            return None
+        return lambda key: key[0] == post_id
+
+    def _get_posts_query(
+        self,
+        public_predicate: Predicate = None,
+        post_predicate: Predicate = None,
+        meme_predicate: Predicate = None,
+        crop_predicate: Predicate = None,
+        subquery_filters: Subqueries = [],
+    ) -> Query:
         # If only one suquery is passed, wrap it in list
         if type(subquery_filters) is Subquery:
             subquery_filters = [subquery_filters]
 
         # Construct query
-        q = self._session.query(Post)
+        q = self._session.query(Post).filter(self._cropped_predicate())
         if public_predicate is not None:
             q = q.join(Public).filter(public_predicate)
         if post_predicate is not None:
@@ -94,8 +171,32 @@ class Mixer:
                 subq,
                 and_(subq.c.public_id == Post.public_id, subq.c.id == Post.id)
             )
-        post = q.order_by(func.random()).limit(1).one()
-        return post
+        return q
+
+    def _cropped_predicate(self) -> Predicate:
+        # Posts with a meme that is not cropped can't be a base or a donor,
+        # alias keeps memes joined by other predicates out of correlation
+        uncropped = aliased(Meme)
+        return and_(
+            Post.n_pictures > 0,
+            ~self._session.query(uncropped).filter(
+                uncropped.public_id == Post.public_id,
+                uncropped.post_id == Post.id,
+                or_(uncropped.ocr_status != OCR_DONE, uncropped.n_crops == 0)
+            ).exists()
+        )
+
+    def _get_indexed_mix(self, max_attempts: int = 8, **filters) -> Tuple[Post, List[List[Post]]]:
+        for _ in range(max_attempts):
+            base_key, keys = self._index.sample_mix(**filters)
+            posts = self._load_posts([base_key] + [k for ks in keys for k in ks])
+            # Posts could be deleted since index was loaded
+            missing = ({base_key} | {k for ks in keys for k in ks}) - posts.keys()
+            if not missing:
+                return posts[base_key], [[posts[k] for k in ks] for ks in keys]
+            for key in missing:
+                self._index.discard(key)
+        raise NoResultFound('No row was found when one was required')
 
     def _stack_predicates(
             self,
@@ -187,32 +288,12 @@ class Mixer:
                 )
         return crop_predicate
 
-    def _resize(self, to_resize: Jpeg, size: Tuple[int, int]) -> Tuple[Jpeg, float, float]:
-        w, h = to_resize.size
-        # If horizontal image is stretched mostly vertically,
-        # limit horizontal shrink
-        w_ratio, h_ratio = size[0] / w, size[1] / h
-        new_w, new_h = size
-        if w_ratio > 2 and h_ratio < 1:
-            new_w *= 2
-            new_h *= 0.5
-            resized = to_resize.resize((min(int(new_w), size[0]), max(int(new_h), size[1])), Image.ANTIALIAS)
-            return resized, new_w, new_h
-        # If image is shrinked too much, limit shrinkage
-        if w_ratio < 0.5 or h_ratio < 0.5:
-            new_w *= 0.5
-            new_h *= 0.5
-            resized = to_resize.resize((max(int(new_w), size[0]), max(int(new_h), size[1])), Image.ANTIALIAS)
-            return resized, new_w, new_h
-        resized = to_resize.resize(size, Image.ANTIALIAS)
-        return resized, new_w, new_h
-
     def _extract_data_from_models(
             self,
             base_post: Post,
             crops: List[Crop]
-    ) -> Tuple[BaseJpegs, CropJpegs, PositionJsonDicts]:
-        # Load base images, crops and convert json strings with positions
+    ) -> Tuple[BasePixels, CropPixels, PositionJsonDicts]:
+        # Load base pixels, crops and convert json strings with positions
         bases = [self._get_image(m) for m in base_post.pictures]
         crops = [[self._get_image(c) for c in pic_c] for pic_c in crops]
         positions = [[self._get_json(c.position) for c in m.crops]
@@ -257,6 +338,15 @@ class Mixer:
             base_post: base post with base images
             posts: list of post models for each base picture in post
         """
+        if self._index is not None:
+            return self._get_indexed_mix(
+                include_publics=include_publics, exclude_publics=exclude_publics,
+                include_posts=include_posts, exclude_posts=exclude_posts,
+                from_date=from_date, to_date=to_date,
+                include_text=include_text, exclude_text=exclude_text,
+                exact_pics=exact_pics, min_pics=min_pics, max_pics=max_pics,
+                exact_crops=exact_crops, min_crops=min_crops, max_crops=max_crops
+            )
         # Create picture count filter subqueries
         pics_filters = self._get_pics_filters(exact_pics, min_pics, max_pics)
         # Create crop count filter subqueries
@@ -276,50 +366,69 @@ class Mixer:
         )
 
         # Get a random base post with all the pictures
-        base_post = self._get_random_post(
+        base_filters = dict(
             public_predicate=public_predicate,
             post_predicate=post_predicate,
             crop_predicate=crop_predicate,
             subquery_filters=filter_sqs
         )
+        # Load pictures and crops of base post at once instead of lazily
+        base_key = self._get_random_post_key(**base_filters)
+        base_post = self._load_posts([base_key]).get(base_key)
+        if base_post is None:
+            # Cached candidate was deleted, sample from existing ones
+            base_post = self._get_random_post(**base_filters)
+            base_key = (base_post.id, base_post.public_id)
+            base_post = self._load_posts([base_key])[base_key]
+        base_crops_count_f = self._n_crops_filter(sum(m.n_crops for m in base_post.pictures))
+        donor_filters = dict(
+            public_predicate=public_predicate,
+            post_predicate=post_predicate,
+            crop_predicate=crop_predicate,
+            exclude_post_id=base_post.id
+        )
         # Fetch random posts
-        posts = []
+        keys = []
         # For each picture in base post
         for i, base_picture in enumerate(base_post.pictures):
-            picture_posts = []
-            # and for each crop in picture
-            for j, crop in enumerate(base_picture.crops):
-                # Sample a random post that is:
-                # - not from base post
-                # - from/not from certain public
-                # - has the same number of pictures in post as base post
-                # - has the same number of crops as the current picture
-                base_post_predicate = self._stack_predicates(
-                    post_predicate,
-                    Post.id != base_post.id
+            # and for each crop in picture, sample a donor
+            keys.append([
+                self._sample_donor(
+                    self._get_random_post_key, filter_sqs, crops_filters, base_crops_count_f,
+                    **donor_filters
                 )
-                base_crops_count_f = self._n_crops_filter(self._count_crops(base_picture))
-                try:
-                    sample = self._get_random_post(
-                        public_predicate=public_predicate,
-                        post_predicate=base_post_predicate,
-                        crop_predicate=crop_predicate,
-                        subquery_filters=filter_sqs + [base_crops_count_f]
-                    )
-                except NoResultFound:
-                    # If none posts can be found, filter on number of pictures is dropped
-                    sample = self._get_random_post(
-                        public_predicate=public_predicate,
-                        post_predicate=base_post_predicate,
-                        crop_predicate=crop_predicate,
-                        subquery_filters=crops_filters + [base_crops_count_f]
-                    )
-                picture_posts.append(sample)
-            # Save crop
-            posts.append(picture_posts)
-
+                for crop in base_picture.crops
+            ])
+        # Load pictures and crops of all sampled posts at once
+        loaded = self._load_posts(k for picture_keys in keys for k in picture_keys)
+        posts = [[
+            loaded[k] if k in loaded else self._sample_donor(
+                self._get_random_post, filter_sqs, crops_filters, base_crops_count_f,
+                **donor_filters
+            )
+            for k in picture_keys
+        ] for picture_keys in keys]
         return base_post, posts
 
+    def _sample_donor(
+            self,
+            get_random: Callable,
+            filter_sqs: Subqueries,
+            crops_filters: Subqueries,
+            base_crops_count_f: Subquery,
+            **predicates
+    ) -> Union[Post, PostKey]:
+        # Sample a random post that is:
+        # - not from base post
+        # - from/not from certain public
+        # - has the same number of pictures in post as base post
+        # - has the same number of crops as the current picture
+        try:
+            return get_random(subquery_filters=filter_sqs + [base_crops_count_f], **predicates)
+        except NoResultFound:
+            # If none posts can be found, filter on number of pictures is dropped
+            return get_random(subquery_filters=crops_filters + [base_crops_count_f], **predicates)
+
     def pick_crops(
             self,
             base_post: Post,
@@ -338,6 +447,16 @@ class Mixer:
             base_post: base post with base images
             crops: list of crop models for each base picture in post
         """
+        base_post, crops = self._pick_crops(base_post, posts, how=how)
+        self._load_crop_pictures(c for picture_crops in crops for c in picture_crops)
+        return base_post, crops
+
+    def _pick_crops(
+            self,
+            base_post: Post,
+            posts: List[List[Post]],
+            how: str = 'abstract'
+    ) -> Tuple[Post, List[List[Crop]]]:
         crops = []
         # For each picture in base post
         for i, picture_posts in enumerate(posts):
@@ -349,6 +468,10 @@ class Mixer:
                     picture_crops.append(crop)
                 crops.append(picture_crops)
             elif how == 'firstonly':
+                # Base picture without crops has nothing to take
+                if not picture_posts:
+                    crops.append([])
+                    continue
                 post = picture_posts[0]
                 pic_idx = min(i, len(post.pictures)) - 1
                 crops.append(post.pictures[pic_idx].crops)
@@ -370,34 +493,10 @@ class Mixer:
             outputs: list of composed pictures
         """
         bases, all_crops, all_positions = self._extract_data_from_models(base_post, crops)
-        outputs = []
-        for base, crops, positions in zip(bases, all_crops, all_positions):
-            out = base.copy()
-            for crop, pos in zip(crops, positions):
-                x1, x2 = pos['x']
-                y1, y2 = pos['y']
-                w, h = x2 - x1, y2 - y1
-                resized, w_r, h_r = self._resize(crop, (w, h))
-                # resized = resize(crop, (w, h))
-                # w_r, h_r = resized.size
-                # offset_x, offset_y = max(0, (w_r - w) / 2), max(0, (h_r - h) / 2)
-                # new_pos = [
-                #  max(min(int(x1 - offset_x), base.size[0]), 0),
-                #  max(min(int(y1 - offset_y), base.size[1]), 0),
-                #  max(min(int(x2 + offset_x), base.size[0]), 0),
-                #  max(min(int(y2 + offset_y), base.size[1]), 0),
-                # ]
-                # print(f'x1 {x1}, y1 {y1}, x2 {x2}, y2 {y2}')
-                # print(f'w, h: {w, h}')
-                # print(f'w_r, h_r: {w_r, h_r}')
-                # print(f'offset_x, offset_y: {offset_x, offset_y}')
-                # print(new_pos[2] - new_pos[0], new_pos[3] - new_pos[1])
-                # print('x1 {}, y1 {}, x2 {}, y2 {}'.format(*new_pos))
-                # print()
-                # out.paste(resized, new_pos)
-                out.paste(resized, (x1, y1, x2, y2))
-            outputs.append(out)
-        return outputs
+        boxes = [[(pos['x'][0], pos['y'][0], pos['x'][1], pos['y'][1]) for pos in positions]
+                 for positions in all_positions]
+        outputs = self._compositor.compose_many(bases, all_crops, boxes)
+        return [to_image(out) for out in outputs]
 
     def save_to_database(
             self,
@@ -419,6 +518,7 @@ class Mixer:
             generated_post_id=gen_post.id,
             index=i if len(pictures) > 1 else None
         ) for i, p in enumerate(pictures)]
+        store_pictures(gen_memes)
         self._session.add_all(gen_memes)
         self._session.commit()
         # Create generated crops for each crop in each picture in base post
@@ -431,6 +531,133 @@ class Mixer:
         self._session.commit()
         # Commit changes
 
+    def _load_posts(self, keys: Iterable[PostKey]) -> Dict[PostKey, Post]:
+        # SQLite scans tables for row value IN lists, OR of keys uses primary key index instead
+        keys = list(set(keys))
+        posts = {}
+        for i in range(0, len(keys), IN_CHUNK_SIZE):
+            q = self._session.query(Post) \
+                             .options(*MIX_LOAD_OPTIONS) \
+                             .filter(or_(*[and_(Post.id == post_id, Post.public_id == public_id)
+                                           for post_id, public_id in keys[i:i + IN_CHUNK_SIZE]]))
+            posts.update(((p.id, p.public_id), p) for p in q)
+        return posts
+
+    def _load_crop_pictures(self, crops: Iterable[Crop]) -> None:
+        # Crops without a blob may store their picture in the row, or be lazy and
+        # store none, both are only known once it's loaded, in one query for all
+        unloaded = {c.id: c for c in crops
+                    if c.picture_hash is None and 'picture' in inspect(c).unloaded}
+        ids = list(unloaded)
+        for i in range(0, len(ids), IN_CHUNK_SIZE):
+            q = self._session.query(Crop.id, Crop.picture) \
+                             .filter(Crop.id.in_(ids[i:i + IN_CHUNK_SIZE]))
+            for crop_id, picture in q:
+                set_committed_value(unloaded[crop_id], 'picture', picture)
+
+    def _prefetch(self, base_post: Post, crops: List[List[Crop]]) -> None:
+        '''Loads everything compose reads, so it can run in threads without the session'''
+        memes = list(base_post.pictures)
+        for picture_crops in crops:
+            for crop in picture_crops:
+                if crop.is_lazy():
+                    memes.append(crop.base)
+                elif crop.picture_hash is None:
+                    crop.picture
+        for meme in memes:
+            if meme.duplicate_of is not None:
+                meme = meme.source
+            if meme.picture_hash is None:
+                meme.picture
+
+    def _compose_to_bytes(self, mix: Tuple[Post, List[List[Crop]]]) -> List[bytes]:
+        return [self._image_to_bytes(p) for p in self.compose(*mix)]
+
+    def _make_generated_post(
+            self,
+            base_post: Post,
+            crops: List[List[Crop]],
+            pictures: List[bytes]
+    ) -> GeneratedPost:
+        gen_post = GeneratedPost(
+            base_post_id=base_post.id,
+            base_public_id=base_post.public_id,
+            posted=0
+        )
+        for i, (picture, picture_crops) in enumerate(zip(pictures, crops)):
+            gen_meme = GeneratedMeme(
+                picture=picture,
+                post=gen_post,
+                index=i if len(pictures) > 1 else None
+            )
+            for j, crop in enumerate(picture_crops):
+                GeneratedCrop(crop_id=crop.id, base=gen_meme, index=j)
+        return gen_post
+
+    def generate_many(
+            self,
+            n: int,
+            how: str = 'firstonly',
+            workers: int = 4,
+            **filters
+    ) -> StatDict:
+        """Generate a batch of mixes and save them to the database.
+
+        Mixes are sampled from the index (a temporary one is loaded if mixer
+        has none), their posts are loaded with a few queries, pictures are
+        composed in a thread pool and saved in one transaction.
+
+        Params:
+            n: number of mixes to generate
+            how: method of picking crops, see `pick_crops`
+            workers: number of threads composing pictures
+            filters: filters of `get_random_mix`
+        Returns:
+            stats: number of generated posts and pictures, skipped mixes and seconds taken
+        """
+        started = time.perf_counter()
+        index = self._index if self._index is not None else MixIndex()
+        sampled = []
+        for _ in range(n):
+            try:
+                sampled.append(index.sample_mix(**filters))
+            except NoResultFound:
+                # No donors match the crops of sampled base post, counted as skipped
+                continue
+        keys = {k for base_key, picture_keys in sampled
+                for k in [base_key] + [k for ks in picture_keys for k in ks]}
+        posts = self._load_posts(keys)
+        # Posts could be deleted since index was loaded
+        for key in keys - posts.keys():
+            index.discard(key)
+
+        mixes = []
+        for base_key, picture_keys in sampled:
+            try:
+                donors = [[posts[k] for k in ks] for ks in picture_keys]
+                mixes.append(self._pick_crops(posts[base_key], donors, how=how))
+            except (KeyError, IndexError):
+                # Deleted posts and donors without a crop to pick
+                continue
+        # Pictures of crops picked for all mixes are loaded at once
+        self._load_crop_pictures(c for _, crops in mixes for picture_crops in crops for c in picture_crops)
+        for mix in mixes:
+            self._prefetch(*mix)
+
+        with ThreadPoolExecutor(workers) as pool:
+            pictures = list(pool.map(self._compose_to_bytes, mixes))
+        gen_posts = [self._make_generated_post(*mix, p) for mix, p in zip(mixes, pictures)]
+        gen_memes = [m for p in gen_posts for m in p.pictures]
+        store_pictures(gen_memes)
+        insert_generated(self._session, gen_posts)
+        self._session.commit()
+        return {
+            'n_posts': len(gen_posts),
+            'n_pics': len(gen_memes),
+            'skipped': n - len(gen_posts),
+            'seconds': time.perf_counter() - started,
+        }
+
     def save_to_file(self, pictures: List[Jpeg], filename: str) -> None:
         filename = Path(filename)
         for i, pic in enumerate(pictures):
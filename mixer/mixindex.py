@@ -0,0 +1,346 @@
+import re
+import time
+import numpy as np
+from threading import Lock
+from operator import le, ge, eq
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from sqlalchemy import func, select
+from sqlalchemy.exc import NoResultFound
+from database.engine import Session
+from database.bulk import IN_CHUNK_SIZE
+from database.models import Public, Post, Meme, Crop
+
+# (post id, public id), primary key of a post
+PostKey = Tuple[str, str]
+
+
+def _like_to_regex(pattern: str) -> re.Pattern:
+    # LIKE is case insensitive and matches the whole string
+    parts = ['.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern]
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+class MixIndex:
+    '''Keeps metadata of posts, memes and crops in arrays to sample mixes without SQL.
+
+    Rows are loaded once and then refreshed incrementally by meme and crop
+    ids. Refreshing reloads crops of memes that were recropped or rejected,
+    and the whole index once loaded memes were deleted. Posts without
+    pictures or with a meme that has no crops are left out. Deleted posts
+    are only sampled until they are discarded or the index is refreshed.
+    '''
+
+    def __init__(self, refresh_interval: float = None, seed: int = None):
+        self._refresh_interval = refresh_interval
+        self._rng = np.random.default_rng(seed)
+        self._lock = Lock()
+        self.reload()
+
+    def reload(self) -> None:
+        with self._lock:
+            self._reset()
+            self._refresh()
+
+    def _reset(self) -> None:
+        self._publics: Dict[str, int] = {}
+        self._domains: List[str] = []
+        self._post_index: Dict[PostKey, int] = {}
+        self._post_keys: List[PostKey] = []
+        self._meme_index: Dict[int, int] = {}
+        self._texts: Dict[Optional[str], int] = {}
+        self._text_list: List[Optional[str]] = []
+        # Post arrays
+        self._post_ids = np.empty(0, dtype=object)
+        self._post_public = np.empty(0, dtype=np.int32)
+        self._post_date = np.empty(0, dtype='U30')
+        self._post_alive = np.empty(0, dtype=bool)
+        # Meme and crop arrays
+        self._meme_ids = np.empty(0, dtype=np.int64)
+        self._meme_post = np.empty(0, dtype=np.int32)
+        self._meme_order = np.empty(0, dtype=np.int32)
+        self._meme_version = np.empty(0, dtype=np.int32)
+        self._crop_meme = np.empty(0, dtype=np.int32)
+        self._crop_text = np.empty(0, dtype=np.int32)
+        self._last_meme_id = 0
+        self._last_crop_id = 0
+
+    def refresh(self) -> None:
+        '''Adds rows inserted since the last refresh and reconciles changed ones'''
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        with Session() as session:
+            # Ids of deleted memes may be given to new ones, so the index
+            # starts over once loaded memes don't match stored ones
+            stored = session.execute(
+                select(Meme.id, Meme.public_id, Meme.post_id, Meme.n_crops, Meme.ocr_version)
+                .join(Post, (Post.public_id == Meme.public_id) & (Post.id == Meme.post_id))
+                .where(Meme.id <= self._last_meme_id)
+                .order_by(Meme.id)
+            ).all()
+            if not self._matches(stored):
+                self._reset()
+                stored = []
+            # Crops up to this id belong to memes that are already stored
+            max_crop_id = session.execute(select(func.max(Crop.id))).scalar() or 0
+            for public_id, domain in session.execute(select(Public.id, Public.domain)):
+                if public_id not in self._publics:
+                    self._publics[public_id] = len(self._domains)
+                    self._domains.append(domain)
+            memes = session.execute(
+                select(Meme.id, Meme.public_id, Meme.post_id, Meme.index,
+                       Meme.n_crops, Meme.ocr_version, Post.date)
+                .join(Post, (Post.public_id == Meme.public_id) & (Post.id == Meme.post_id))
+                .where(Meme.id > self._last_meme_id)
+                .order_by(Meme.id)
+            ).all()
+            crops = session.execute(
+                select(Crop.id, Crop.meme_id, Crop.text)
+                .where(Crop.id > self._last_crop_id, Crop.id <= max_crop_id)
+                .order_by(Crop.id)
+            ).all()
+            self._add_memes(memes)
+            self._add_crops(crops)
+            self._last_crop_id = max(self._last_crop_id, max_crop_id)
+            # Memes recropped or rejected since they were loaded get their crops loaded again
+            counts = [(n, v) for *_, n, v in stored] + [(n, v) for *_, n, v, _ in memes]
+            self._reload_stale_crops(session, counts, max_crop_id)
+        # Counters are derived from loaded rows, so they match each other
+        self._post_n_pictures = np.bincount(self._meme_post, minlength=len(self._post_keys))
+        self._meme_n_crops = np.bincount(self._crop_meme, minlength=len(self._meme_post))
+        # Pending and rejected memes have no crops, their posts can't be a base or a donor
+        self._post_cropped = (self._post_n_pictures > 0) & ~self._posts_of_memes(self._meme_n_crops == 0)
+        # Memes of each post in order of their index, post i owns memes[offsets[i]:offsets[i + 1]]
+        self._post_memes = np.lexsort((self._meme_order, self._meme_post))
+        self._post_offsets = np.searchsorted(
+            self._meme_post[self._post_memes], np.arange(len(self._post_keys) + 1)
+        )
+        # Integer codes of post ids are faster to compare than strings
+        self._post_id_codes = np.unique(self._post_ids.astype(str), return_inverse=True)[1] \
+            if len(self._post_ids) else np.empty(0, dtype=np.intp)
+        self._text_masks = {}
+        self._count_masks = {}
+        self._refreshed = time.monotonic()
+
+    def _add_memes(self, memes: List[Tuple]) -> None:
+        new_posts = []
+        meme_ids, meme_post, meme_order = [], [], []
+        for meme_id, public_id, post_id, index, _, _, date in memes:
+            key = (post_id, public_id)
+            if key not in self._post_index:
+                self._post_index[key] = len(self._post_keys)
+                self._post_keys.append(key)
+                new_posts.append((post_id, self._publics[public_id], date))
+            self._meme_index[meme_id] = len(self._meme_index)
+            meme_ids.append(meme_id)
+            meme_post.append(self._post_index[key])
+            meme_order.append(index or 0)
+        if memes:
+            self._last_meme_id = memes[-1][0]
+        if new_posts:
+            ids, publics, dates = zip(*new_posts)
+            self._post_ids = np.concatenate([self._post_ids, np.array(ids, dtype=object)])
+            self._post_public = np.concatenate([self._post_public, np.array(publics, dtype=np.int32)])
+            self._post_date = np.concatenate([self._post_date, np.array(dates, dtype='U30')])
+            self._post_alive = np.concatenate([self._post_alive, np.ones(len(ids), dtype=bool)])
+        self._meme_ids = np.concatenate([self._meme_ids, np.array(meme_ids, dtype=np.int64)])
+        self._meme_post = np.concatenate([self._meme_post, np.array(meme_post, dtype=np.int32)])
+        self._meme_order = np.concatenate([self._meme_order, np.array(meme_order, dtype=np.int32)])
+
+    def _add_crops(self, crops: List[Tuple]) -> None:
+        crop_meme, crop_text = [], []
+        for _, meme_id, text in crops:
+            # Crops of deleted memes
+            if meme_id not in self._meme_index:
+                continue
+            if text not in self._texts:
+                self._texts[text] = len(self._text_list)
+                self._text_list.append(text)
+            crop_meme.append(self._meme_index[meme_id])
+            crop_text.append(self._texts[text])
+        self._crop_meme = np.concatenate([self._crop_meme, np.array(crop_meme, dtype=np.int32)])
+        self._crop_text = np.concatenate([self._crop_text, np.array(crop_text, dtype=np.int32)])
+
+    def _matches(self, stored: List[Tuple]) -> bool:
+        # Loaded memes are still stored with the same ids and posts
+        if len(stored) != len(self._meme_ids):
+            return False
+        return all(
+            meme_id == self._meme_ids[i] and self._post_keys[self._meme_post[i]] == (post_id, public_id)
+            for i, (meme_id, public_id, post_id, _, _) in enumerate(stored)
+        )
+
+    def _reload_stale_crops(self, session, counts: List[Tuple], max_crop_id: int) -> None:
+        # Memes whose stored number of crops or OCR version differ from the
+        # loaded ones had their crops replaced or deleted
+        n_crops = np.array([n for n, _ in counts], dtype=np.int64)
+        versions = np.array([-1 if v is None else v for _, v in counts], dtype=np.int32)
+        loaded = np.bincount(self._crop_meme, minlength=len(self._meme_post))
+        stale = (n_crops != loaded)
+        stale[:len(self._meme_version)] |= versions[:len(self._meme_version)] != self._meme_version
+        self._meme_version = versions
+        if not stale.any():
+            return
+        keep = ~stale[self._crop_meme]
+        self._crop_meme, self._crop_text = self._crop_meme[keep], self._crop_text[keep]
+        stale_ids = self._meme_ids[stale].tolist()
+        crops = []
+        for i in range(0, len(stale_ids), IN_CHUNK_SIZE):
+            crops.extend(session.execute(
+                select(Crop.id, Crop.meme_id, Crop.text)
+                .where(Crop.meme_id.in_(stale_ids[i:i + IN_CHUNK_SIZE]), Crop.id <= max_crop_id)
+                .order_by(Crop.id)
+            ).all())
+        self._add_crops(crops)
+
+    def discard(self, key: PostKey) -> None:
+        '''Stops sampling post that was deleted from the database'''
+        with self._lock:
+            if key in self._post_index:
+                self._post_alive[self._post_index[key]] = False
+
+    def _posts_of_memes(self, meme_mask: np.ndarray) -> np.ndarray:
+        mask = np.zeros(len(self._post_keys), dtype=bool)
+        mask[self._meme_post[meme_mask]] = True
+        return mask
+
+    def _count_mask(self, n: int, op: Callable = eq) -> np.ndarray:
+        # Posts having a cropped meme with number of crops matching op, cached until next refresh
+        if (n, op) not in self._count_masks:
+            meme_mask = (self._meme_n_crops > 0) & op(self._meme_n_crops, n)
+            self._count_masks[(n, op)] = self._posts_of_memes(meme_mask)
+        return self._count_masks[(n, op)]
+
+    def _text_mask(self, pattern: str) -> np.ndarray:
+        # Unique texts are matched once per pattern until next refresh
+        if pattern not in self._text_masks:
+            regex = _like_to_regex(pattern)
+            self._text_masks[pattern] = np.array(
+                [t is not None and regex.fullmatch(t) is not None for t in self._text_list],
+                dtype=bool
+            )
+        return self._text_masks[pattern]
+
+    def _post_mask(
+            self,
+            include_publics: List[str] = None,
+            exclude_publics: List[str] = None,
+            include_posts: List[str] = None,
+            exclude_posts: List[str] = None,
+            from_date: str = None,
+            to_date: str = None,
+            include_text: Union[str, List[str]] = None,
+            exclude_text: Union[str, List[str]] = None,
+    ) -> np.ndarray:
+        mask = self._post_alive & self._post_cropped
+        if include_publics is not None:
+            ids = [i for i, d in enumerate(self._domains) if d in include_publics]
+            mask &= np.isin(self._post_public, ids)
+        if exclude_publics is not None:
+            ids = [i for i, d in enumerate(self._domains) if d in exclude_publics]
+            mask &= ~np.isin(self._post_public, ids)
+        if include_posts is not None:
+            mask &= np.isin(self._post_ids, [str(p) for p in include_posts])
+        if exclude_posts is not None:
+            mask &= ~np.isin(self._post_ids, [str(p) for p in exclude_posts])
+        if from_date is not None:
+            mask &= self._post_date >= from_date
+        if to_date is not None:
+            mask &= self._post_date <= to_date
+        if include_text is not None or exclude_text is not None:
+            # Some crop of the post has to match all of the patterns
+            if type(include_text) is str:
+                include_text = [include_text]
+            if type(exclude_text) is str:
+                exclude_text = [exclude_text]
+            text_mask = np.array([t is not None for t in self._text_list], dtype=bool)
+            for pattern in include_text or []:
+                text_mask &= self._text_mask(pattern)
+            for pattern in exclude_text or []:
+                text_mask &= ~self._text_mask(pattern)
+            crop_memes = self._crop_meme[text_mask[self._crop_text]]
+            meme_mask = np.zeros(len(self._meme_post), dtype=bool)
+            meme_mask[crop_memes] = True
+            mask &= self._posts_of_memes(meme_mask)
+        return mask
+
+    def _pics_mask(self, exact_pics: int, min_pics: int, max_pics: int) -> np.ndarray:
+        mask = np.ones(len(self._post_keys), dtype=bool)
+        for n, op in ((exact_pics, eq), (min_pics, ge), (max_pics, le)):
+            if n is not None:
+                mask &= (self._post_n_pictures > 0) & op(self._post_n_pictures, n)
+        return mask
+
+    def _crops_mask(self, exact_crops: int, min_crops: int, max_crops: int) -> np.ndarray:
+        mask = np.ones(len(self._post_keys), dtype=bool)
+        for n, op in ((exact_crops, eq), (min_crops, ge), (max_crops, le)):
+            if n is not None:
+                # Some cropped meme of the post has to match each filter
+                mask &= self._count_mask(n, op)
+        return mask
+
+    def _choice(self, candidates: np.ndarray) -> int:
+        if len(candidates) == 0:
+            raise NoResultFound('No row was found when one was required')
+        return int(candidates[self._rng.integers(len(candidates))])
+
+    def sample_mix(
+            self,
+            include_publics: List[str] = None,
+            exclude_publics: List[str] = None,
+            include_posts: List[str] = None,
+            exclude_posts: List[str] = None,
+            from_date: str = None,
+            to_date: str = None,
+            include_text: Union[str, List[str]] = None,
+            exclude_text: Union[str, List[str]] = None,
+            exact_pics: int = None,
+            min_pics: int = None,
+            max_pics: int = None,
+            exact_crops: int = None,
+            min_crops: int = None,
+            max_crops: int = None
+    ) -> Tuple[PostKey, List[List[PostKey]]]:
+        """Sample keys of a base post and posts for each of its crops.
+
+        Takes the same filters as Mixer.get_random_mix, posts are sampled
+        uniformly among the ones matching filters.
+
+        Returns:
+            base_post: key of base post
+            posts: keys of posts for each crop of each base picture
+        """
+        if self._refresh_interval is not None and \
+                time.monotonic() - self._refreshed > self._refresh_interval:
+            self.refresh()
+        with self._lock:
+            post_mask = self._post_mask(
+                include_publics, exclude_publics, include_posts, exclude_posts,
+                from_date, to_date, include_text, exclude_text
+            )
+            pics_mask = self._pics_mask(exact_pics, min_pics, max_pics)
+            crops_mask = self._crops_mask(exact_crops, min_crops, max_crops)
+            base = self._choice(np.flatnonzero(post_mask & pics_mask & crops_mask))
+
+            # Base pictures in order of their index in post
+            base_memes = self._post_memes[self._post_offsets[base]:self._post_offsets[base + 1]]
+            # Sampled posts have as many crops in a meme as base post has in total
+            n_crops = int(self._meme_n_crops[base_memes].sum())
+            # Posts with the same id as base post are never sampled
+            post_mask &= self._count_mask(n_crops) & (self._post_id_codes != self._post_id_codes[base])
+            candidates = np.flatnonzero(post_mask & pics_mask & crops_mask)
+            # If none posts can be found, filter on number of pictures is dropped
+            fallback = np.flatnonzero(post_mask & crops_mask)
+
+            posts = []
+            for meme in base_memes:
+                picture_posts = []
+                for _ in range(self._meme_n_crops[meme]):
+                    try:
+                        sample = self._choice(candidates)
+                    except NoResultFound:
+                        sample = self._choice(fallback)
+                    picture_posts.append(self._post_keys[sample])
+                posts.append(picture_posts)
+            return self._post_keys[base], posts
@@ -0,0 +1,92 @@
+import time
+import random
+from threading import Lock
+from typing import Callable, Dict, List, Tuple
+from sqlalchemy import inspect
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import Query, Session
+
+Key = Tuple
+KeyPredicate = Callable[[Key], bool]
+
+
+class CandidateSampler:
+    '''Samples random rows of queries in constant time.
+
+    Primary keys of all rows matched by a query are cached by its compiled
+    SQL for `ttl` seconds. Rows are drawn from the cached keys, deleted
+    and excluded ones are rejected and drawn again.
+    '''
+
+    def __init__(self, ttl: float = 60, max_rejections: int = 32):
+        self._ttl = ttl
+        self._max_rejections = max_rejections
+        self._cache: Dict[str, Tuple[float, List[Key]]] = {}
+        self._lock = Lock()
+
+    def _get_signature(self, query: Query) -> str:
+        return str(query.statement.compile(compile_kwargs={'literal_binds': True}))
+
+    def get_candidates(self, model, query: Query) -> List[Key]:
+        # Keys are in order of model's primary key, as Session.get expects
+        query = query.with_entities(*inspect(model).primary_key)
+        signature = self._get_signature(query)
+        with self._lock:
+            cached = self._cache.get(signature)
+        if cached is not None and time.monotonic() - cached[0] < self._ttl:
+            return cached[1]
+        # Rows are kept as many times as query returns them, like ORDER BY random() did
+        candidates = [tuple(r) for r in query.all()]
+        with self._lock:
+            self._cache[signature] = (time.monotonic(), candidates)
+        return candidates
+
+    def sample_key(self, model, query: Query, exclude: KeyPredicate = None) -> Key:
+        '''Returns key of random row of query without loading it, the row could be deleted since'''
+        candidates = self.get_candidates(model, query)
+        for _ in range(self._max_rejections):
+            if not candidates:
+                break
+            key = random.choice(candidates)
+            if exclude is None or not exclude(key):
+                return key
+        candidates = [k for k in candidates if exclude is None or not exclude(k)]
+        if not candidates:
+            raise NoResultFound('No row was found when one was required')
+        return random.choice(candidates)
+
+    def sample(
+            self,
+            session: Session,
+            model,
+            query: Query,
+            exclude: KeyPredicate = None,
+    ):
+        '''Returns random row of query, raises NoResultFound if there is none'''
+        candidates = self.get_candidates(model, query)
+        for _ in range(self._max_rejections):
+            if not candidates:
+                raise NoResultFound('No row was found when one was required')
+            key = random.choice(candidates)
+            if exclude is not None and exclude(key):
+                continue
+            # Row could be deleted since candidates were cached
+            obj = session.get(model, key)
+            if obj is not None:
+                return obj
+        # Most candidates are rejected, go through all of them once
+        for key in random.sample(candidates, len(candidates)):
+            if exclude is not None and exclude(key):
+                continue
+            obj = session.get(model, key)
+            if obj is not None:
+                return obj
+        raise NoResultFound('No row was found when one was required')
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+# Shared by mixers, so candidates outlive a single mix
+default_sampler = CandidateSampler()
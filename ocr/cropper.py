@@ -2,42 +2,146 @@ import easyocr
 import numpy as np
 from PIL import Image
 from PIL.JpegImagePlugin import JpegImageFile as Jpeg
-from sqlalchemy import func
+from sqlalchemy import func, or_
 from sqlalchemy.exc import IntegrityError
 import json
 from io import BytesIO
-from typing import Tuple, List, Dict
-from database.models import Post, Meme, Crop
+from collections import defaultdict
+from itertools import islice
+from typing import Tuple, List, Dict, Optional, Iterator, Union
+from database.models import Post, Meme, Crop, OCR_PENDING, OCR_DONE, OCR_REJECTED
 from database.engine import Session
+from database.blobstore import store_pictures
+from database.bulk import insert_crops
 
 
 Bounds = List[Tuple[List[int], str]]
 BboxList = List[Dict[str, List[int]]]
+# Bump when changes to cropping should be tracked in processed memes
+OCR_VERSION = 1
+# (meme id, post id, reason to reject meme, crops, raw detections)
+CropResult = Tuple[int, str, Optional[str], List[Crop], Optional[Bounds]]
+CropFilters = Dict[str, Union[int, float, List[str]]]
+
+DEFAULT_FILTERS: CropFilters = {
+    # Text of watermarks that shouldn't become crops
+    'watermarks': ['comicbook', 'wowlol', 'Класс!'],
+    'min_text_length': 2,
+    # Memes with a number of text boxes outside of these bounds are rejected
+    'min_crops': 1,
+    'max_crops': 6,
+    # Crop area relative to the picture area
+    'min_area_ratio': 0.0005,
+    'max_area_ratio': 0.6,
+    'min_side': 20,
+}
 
 
 class Cropper:
 
-    def __init__(self, session: Session = None):
+    def __init__(
+            self,
+            session: Session = None,
+            bucket_step: int = 128,
+            max_side: int = None,
+            filters: CropFilters = None,
+            delete_rejected: bool = False,
+            lazy_crops: bool = False,
+    ):
         self._session = session if session is not None else Session()
-        self.reader = easyocr.Reader(['ru', 'en'])
+        self._filters = {**DEFAULT_FILTERS, **(filters or {})}
+        # Rejected posts are deleted if set, otherwise their memes are kept
+        # with detections to be refiltered later
+        self._delete_rejected = delete_rejected
+        # Crops are stored as positions only and cut out of memes when needed
+        self._lazy_crops = lazy_crops
+        self._reader = None
+        # Picture sizes are rounded to this step when batching
+        self._bucket_step = bucket_step
+        # OCR runs on pictures downscaled to fit this size
+        self._max_side = max_side
+
+    @property
+    def reader(self) -> easyocr.Reader:
+        # Model is only loaded when OCR is actually needed
+        if self._reader is None:
+            self._reader = easyocr.Reader(['ru', 'en'])
+        return self._reader
+
+    def _pending(self):
+        # Memes processed by older versions of the cropper are processed again,
+        # ones processed before versions were tracked have none and are kept
+        return or_(Meme.ocr_status == OCR_PENDING, Meme.ocr_version < OCR_VERSION)
+
+    def _count_pending(self) -> int:
+        return self._session.query(func.count(Meme.id)) \
+                            .filter(self._pending()) \
+                            .scalar()
 
-    def _get_uncropped_memes(self) -> List[Meme]:
-        memes = self._session.query(Meme).join(Crop, isouter=True) \
-                                         .group_by(Meme.id) \
-                                         .having(func.count(Crop.id) == 0) \
-                                         .all()
-        return memes
+    def _iter_ids(self, *criteria, page_size: int = 500) -> Iterator[int]:
+        # Pages through memes by id, so originals come before their
+        # duplicates and every page is an index range scan
+        last_id = 0
+        while True:
+            # Own session keeps the cursor usable from other threads
+            with Session() as session:
+                ids = session.query(Meme.id) \
+                             .filter(*criteria, Meme.id > last_id) \
+                             .order_by(Meme.id) \
+                             .limit(page_size) \
+                             .all()
+            if not ids:
+                return
+            for i in ids:
+                yield i[0]
+            last_id = ids[-1][0]
+
+    def _iter_pending_ids(self, page_size: int = 500) -> Iterator[int]:
+        return self._iter_ids(self._pending(), page_size=page_size)
 
     def _get_image(self, meme: Meme) -> Jpeg:
-        return Image.open(BytesIO(meme.picture))
+        return Image.open(meme.open_picture())
+
+    def _delete_post(self, public_id: str, post_id: str, reason: str = None) -> None:
+        # Fetch post to delete, post ids are only unique within a public
+        post = self._session.query(Post).filter(Post.public_id == public_id, Post.id == post_id).one()
+        # Reposts of the same pictures would be rejected the same way
+        duplicate_posts = self._session.query(Post).join(Meme).filter(
+            Meme.duplicate_of.in_([m.id for m in post.pictures])
+        ).all()
+        # Delete posts
+        for p in [post] + duplicate_posts:
+            self._session.delete(p)
+        self._session.commit()
+
+    def _reject(self, meme: Meme, reason: str, detections: Bounds = None) -> None:
+        if self._delete_rejected:
+            self._delete_post(meme.public_id, meme.post_id, reason=reason)
+            return
+        self._mark_rejected(meme, detections)
 
-    def _delete_post(self, post_id: str, reason: str = None) -> None:
-        # Fetch post to delete
-        post = self._session.query(Post).filter(Post.id == post_id).one()
-        # Delete post
-        self._session.delete(post)
+    def _mark_rejected(self, meme: Meme, detections: Bounds = None) -> None:
+        for crop in meme.crops:
+            self._session.delete(crop)
+        meme.ocr_status = OCR_REJECTED
+        meme.ocr_version = OCR_VERSION
+        meme.detections = self._dump_detections(detections)
         self._session.commit()
 
+    def _dump_detections(self, bounds: Optional[Bounds]) -> Optional[str]:
+        if bounds is None:
+            return None
+        # Boxes may come as numpy ints, confidence is only there without paragraphs
+        return json.dumps([
+            [[[int(x), int(y)] for x, y in b[0]], b[1], *map(float, b[2:])]
+            for b in bounds
+        ], ensure_ascii=False)
+
+    def _load_detections(self, meme: Meme) -> Optional[Bounds]:
+        if meme.detections is None:
+            return None
+        return json.loads(meme.detections)
+
     def _translate_bounds(self, bounds: Bounds, shape: Tuple[int, int]) -> Bounds:
         def translator(bound):
             b = bound[0]
@@ -58,80 +162,154 @@ class Cropper:
             crops.append(crop)
         return crops
 
-    def _filter_bounds(self, bounds: List[Bounds]) -> None:
-        filters = ['comicbook', 'wowlol', 'Класс!']
-        for f in filters:
-            bounds = filter(lambda x: f not in x[1], bounds)
-        bounds = filter(lambda x: len(x[1]) > 1, bounds)
+    def _filter_bounds(self, bounds: Bounds) -> Bounds:
+        for f in self._filters['watermarks']:
+            bounds = filter(lambda x, f=f: f not in x[1], bounds)
+        bounds = filter(lambda x: len(x[1]) >= self._filters['min_text_length'], bounds)
         bounds = filter(lambda x: x[0] != '@', bounds)
         return list(bounds)
 
-    def _filter_crops_by_size(self, crops: List[Jpeg], image: Jpeg) -> List[Jpeg]:
+    def _filter_crops_by_size(
+            self,
+            crops: List[Jpeg],
+            bounds: Bounds,
+            image: Jpeg
+    ) -> Tuple[List[Jpeg], Bounds]:
         def relative_size(c: Jpeg) -> bool:
             area = c.size[0] * c.size[1]
             ratio = area / image_area
-            if ratio < 0.0005 or ratio > 0.6:
+            if ratio < self._filters['min_area_ratio'] or ratio > self._filters['max_area_ratio']:
                 return False
             return True
 
         def absolute_size(c: Jpeg) -> bool:
             w, h = c.size
-            if w < 20 or h < 20:
+            if w < self._filters['min_side'] or h < self._filters['min_side']:
                 return False
             return True
 
         image_area = image.size[0] * image.size[1]
-        crops = filter(relative_size, crops)
-        crops = filter(absolute_size, crops)
-        return list(crops)
+        # Bounds are filtered along with crops to keep them aligned
+        kept = [(c, b) for c, b in zip(crops, bounds) if relative_size(c) and absolute_size(c)]
+        return [c for c, _ in kept], [b for _, b in kept]
 
     def _image_to_bytes(self, image: Jpeg) -> bytes:
         buf = BytesIO()
         image.save(buf, format='JPEG')
         return buf.getvalue()
 
-    def _save_crops(self, crops: List[Crop]) -> None:
-        self._session.add_all(crops)
+    def _save_crops(self, meme: Meme, crops: List[Crop], detections: Bounds = None) -> None:
+        # Status is committed along with crops, so restarts skip the meme
+        meme.ocr_status = OCR_DONE
+        meme.ocr_version = OCR_VERSION
+        if detections is not None:
+            meme.detections = self._dump_detections(detections)
+        store_pictures(crops)
+        insert_crops(self._session, crops)
         self._session.commit()
 
-    def crop_meme(self, meme: Meme) -> None:
-        # Check if meme wasn't deleted
-        if len(self._session.query(Meme).filter(Meme.id == meme.id).all()) == 0:
-            return
-        # Load picture
-        img = self._get_image(meme)
-        # Feed img into ocr
+    def _copy_crops(self, meme: Meme, source: Meme) -> None:
+        crops = [Crop(
+            meme_id=meme.id,
+            picture=c.picture,
+            picture_hash=c.picture_hash,
+            index=c.index,
+            text=c.text,
+            width=c.width,
+            height=c.height,
+            position=c.position
+        ) for c in source.crops]
+        self._replace_crops(meme, crops)
+
+    def _to_array(self, img: Jpeg, size: Tuple[int, int] = None) -> np.ndarray:
+        img = img.convert('RGB')
+        if size is not None and size != img.size:
+            img = img.resize(size, Image.BILINEAR)
+        # Reader expects BGR arrays
+        return np.ascontiguousarray(np.asarray(img)[:, :, ::-1])
+
+    def _get_detection_size(self, size: Tuple[int, int], max_side: int = None) -> Tuple[int, int]:
+        max_side = self._max_side if max_side is None else max_side
+        if max_side is None or max(size) <= max_side:
+            return size
+        scale = max_side / max(size)
+        return tuple(max(1, int(round(x * scale))) for x in size)
+
+    def _read_bounds(self, img: Jpeg, max_side: int = None) -> Bounds:
+        # Detect on a downscaled copy and map bboxes back to original size
+        w, h = self._get_detection_size(img.size, max_side)
+        bounds = self.reader.readtext(
+            self._to_array(img, (w, h)), paragraph=True, x_ths=2, y_ths=0.25
+        )
+        if (w, h) == img.size:
+            return bounds
+        return self._rescale_bounds(bounds, (img.size[0] / w, img.size[1] / h))
+
+    def _read_bounds_safe(self, img: Jpeg) -> Optional[Bounds]:
         try:
-            bounds = self.reader.readtext(
-                img, paragraph=True, x_ths=2, y_ths=0.25
-            )
+            return self._read_bounds(img)
         except RuntimeError as e:
             print(e)
-            self._delete_post(meme.post_id, reason='OOM')
-            return
+        # Out of memory, try again with half of the size
+        try:
+            w, h = self._get_detection_size(img.size)
+            return self._read_bounds(img, max_side=max(w, h) // 2)
+        except RuntimeError as e:
+            print(e)
+            return None
+
+    def _get_bucket(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        step = self._bucket_step
+        return tuple(max(step, round(x / step) * step) for x in size)
+
+    def _rescale_bounds(self, bounds: Bounds, scale: Tuple[float, float]) -> Bounds:
+        sx, sy = scale
+        return [[[[int(round(x * sx)), int(round(y * sy))] for x, y in box], text]
+                for box, text in bounds]
 
+    def _read_bounds_batched(self, imgs: List[Jpeg], batch_size: int = 8) -> List[Bounds]:
+        # Group images of similar size, so they can share a batch
+        buckets = defaultdict(list)
+        for i, img in enumerate(imgs):
+            buckets[self._get_bucket(self._get_detection_size(img.size))].append(i)
+
+        results = [None] * len(imgs)
+        for (w, h), idxs in buckets.items():
+            for start in range(0, len(idxs), batch_size):
+                batch = idxs[start:start + batch_size]
+                # Batched images must have the same size
+                arrays = [self._to_array(imgs[i], (w, h)) for i in batch]
+                batch_bounds = self.reader.readtext_batched(
+                    arrays, batch_size=batch_size, paragraph=True, x_ths=2, y_ths=0.25
+                )
+                # Map bboxes back to original image sizes
+                for i, bounds in zip(batch, batch_bounds):
+                    img_w, img_h = imgs[i].size
+                    results[i] = self._rescale_bounds(bounds, (img_w / w, img_h / h))
+        return results
+
+    def _make_crops(self, meme: Meme, img: Jpeg, bounds: Bounds) -> Tuple[Optional[str], List[Crop]]:
+        # Returns reason to reject meme or its crops
         # Filter out watermarks, etc
         bounds = self._filter_bounds(bounds)
-        # If meme doesn't contain any text (or contain too much), delete post
-        if len(bounds) not in range(1, 7):
-            self._delete_post(meme.post_id, reason='crop-count')
-            return
+        # If meme doesn't contain any text (or contain too much), reject it
+        if not self._filters['min_crops'] <= len(bounds) <= self._filters['max_crops']:
+            return 'crop-count', []
         # Translate bbox from rectangle coords to x,y min-max
         bounds = self._translate_bounds(bounds, img.size)
         # Get crop images
         crop_imgs = self._crop(img, bounds)
-        # Filter crops by size and delete post if nothing left
-        crop_imgs = self. _filter_crops_by_size(crop_imgs, img)
+        # Filter crops by size and reject meme if nothing left
+        crop_imgs, bounds = self._filter_crops_by_size(crop_imgs, bounds, img)
         if not crop_imgs:
-            self._delete_post(meme.post_id, reason='crop-size')
-            return
+            return 'crop-size', []
         # Create Crop objects and gather all crops information
         crops = []
         for i, (crop_img, (bbox, text)) in enumerate(zip(crop_imgs, bounds)):
             w, h = crop_img.size
             crop = Crop(
                 meme_id=meme.id,
-                picture=self._image_to_bytes(crop_img),
+                picture=None if self._lazy_crops else self._image_to_bytes(crop_img),
                 index=i,
                 text=text,
                 width=w,
@@ -142,12 +320,190 @@ class Cropper:
                 })
             )
             crops.append(crop)
+        return None, crops
+
+    def _crop_bounds(self, meme: Meme, img: Jpeg, bounds: Bounds) -> None:
+        reason, crops = self._make_crops(meme, img, bounds)
+        # Reject memes
+        if reason is not None:
+            self._reject(meme, reason, detections=bounds)
+            return
         # Add crops
-        self._save_crops(crops)
+        self._replace_crops(meme, crops, detections=bounds)
+
+    def _reuse_crops(self, meme: Meme) -> bool:
+        # Reuse crops of already cropped original instead of running OCR again
+        if meme.duplicate_of is not None and meme.source.crops:
+            self._copy_crops(meme, meme.source)
+            return True
+        return False
+
+    def crop_meme(self, meme: Meme) -> None:
+        # Check if meme wasn't deleted
+        if self._session.query(Meme.id).filter(Meme.id == meme.id).first() is None:
+            return
+        if self._reuse_crops(meme):
+            return
+        # Load picture
+        img = self._get_image(meme)
+        # Feed img into ocr
+        bounds = self._read_bounds_safe(img)
+        if bounds is None:
+            self._reject(meme, reason='OOM')
+            return
+        self._crop_bounds(meme, img, bounds)
+
+    def crop_batch(self, memes: List[Meme], batch_size: int = 8) -> None:
+        '''Crops memes running OCR on batches of similarly sized pictures'''
+        memes = [m for m in memes if not self._reuse_crops(m)]
+        meme_ids = [m.id for m in memes]
+        imgs = [self._get_image(m) for m in memes]
+        try:
+            all_bounds = self._read_bounds_batched(imgs, batch_size=batch_size)
+        except RuntimeError as e:
+            # Out of memory, try memes one by one
+            print(e)
+            for meme_id in meme_ids:
+                self.crop_meme_id(meme_id)
+            return
+        for meme_id, img, bounds in zip(meme_ids, imgs, all_bounds):
+            meme = self._session.get(Meme, meme_id)
+            # Meme could be deleted along with a rejected repost
+            if meme is None:
+                continue
+            self._crop_bounds(meme, img, bounds)
+
+    def read_memes(self, meme_ids: List[int], batch_size: int = None) -> List[CropResult]:
+        '''Runs OCR on memes without writing anything to the database'''
+        results = []
+        memes = []
+        for meme in map(lambda x: self._session.get(Meme, x), meme_ids):
+            if meme is None:
+                continue
+            # Crops of cropped original are copied by the writer
+            if meme.duplicate_of is not None and meme.source.crops:
+                results.append((meme.id, meme.post_id, 'duplicate', [], None))
+            else:
+                memes.append(meme)
+        imgs = [self._get_image(m) for m in memes]
+
+        if batch_size is not None:
+            try:
+                all_bounds = self._read_bounds_batched(imgs, batch_size=batch_size)
+            except RuntimeError as e:
+                # Out of memory, try memes one by one
+                print(e)
+                batch_size = None
+        if batch_size is None:
+            all_bounds = list(map(self._read_bounds_safe, imgs))
+
+        for meme, img, bounds in zip(memes, imgs, all_bounds):
+            if bounds is None:
+                results.append((meme.id, meme.post_id, 'OOM', [], None))
+                continue
+            reason, crops = self._make_crops(meme, img, bounds)
+            results.append((meme.id, meme.post_id, reason, crops, bounds))
+        # Nothing is written, release loaded memes and the read transaction
+        self._session.close()
+        return results
+
+    def apply_results(self, results: List[CropResult]) -> None:
+        '''Saves crops and deletes rejected posts given results of read_memes'''
+        for meme_id, post_id, reason, crops, detections in results:
+            meme = self._session.get(Meme, meme_id)
+            # Meme could be deleted along with a rejected post meanwhile
+            if meme is None:
+                continue
+            if reason == 'duplicate':
+                self._reuse_crops(meme)
+            elif reason is not None:
+                self._reject(meme, reason, detections=detections)
+            else:
+                self._replace_crops(meme, crops, detections=detections)
+
+    def crop_meme_id(self, meme_id: int) -> None:
+        meme = self._session.get(Meme, meme_id)
+        # Check if meme wasn't deleted
+        if meme is None:
+            return
+        self.crop_meme(meme)
+
+    def crop(self, batch_size: int = None, chunk_size: int = 64) -> None:
+        """Crop all uncropped memes in the database.
 
-    def crop(self) -> None:
-        memes = self._get_uncropped_memes()
-        for i, meme in enumerate(memes):
-            print((f'[{i + 1}/{len(memes)}] public_id: {meme.public_id[1:]}, '
+        Params:
+            batch_size: run OCR on batches of this many similarly sized memes
+            chunk_size: number of memes to load and group into batches at once
+        """
+        total = self._count_pending()
+        ids = self._iter_pending_ids()
+        if batch_size is not None:
+            for start in range(0, total, chunk_size):
+                print(f'[{min(start + chunk_size, total)}/{total}]')
+                chunk = [self._session.get(Meme, i) for i in islice(ids, chunk_size)]
+                self.crop_batch([m for m in chunk if m is not None], batch_size=batch_size)
+            return
+        # Memes are loaded one at a time to keep memory flat
+        for i, meme_id in enumerate(ids):
+            meme = self._session.get(Meme, meme_id)
+            if meme is None:
+                continue
+            print((f'[{i + 1}/{total}] public_id: {meme.public_id[1:]}, '
                    f'post_id: {meme.post_id}'))
             self.crop_meme(meme)
+
+    def _replace_crops(self, meme: Meme, crops: List[Crop], detections: Bounds = None) -> bool:
+        # Only processed memes can have crops already
+        if meme.ocr_status != OCR_PENDING:
+            # Unchanged crops are kept, so generated memes keep their crops
+            if meme.ocr_status == OCR_DONE and \
+                    [(c.position, c.text) for c in meme.crops] == [(c.position, c.text) for c in crops]:
+                self._save_crops(meme, [], detections=detections)
+                return False
+            for crop in meme.crops:
+                self._session.delete(crop)
+            self._session.flush()
+        self._save_crops(meme, crops, detections=detections)
+        return True
+
+    def refilter_meme(self, meme: Meme) -> Optional[str]:
+        '''Recreates crops of a meme from its stored detections, returns reason if rejected'''
+        detections = self._load_detections(meme)
+        if detections is None:
+            # Duplicates don't store detections, their crops are copied again
+            if meme.duplicate_of is None:
+                return None
+            if not meme.source.crops:
+                self._mark_rejected(meme)
+                return 'source'
+            self._copy_crops(meme, meme.source)
+            return None
+        reason, crops = self._make_crops(meme, self._get_image(meme), detections)
+        # Rejected memes are never deleted here, so looser filters can revive them
+        if reason is not None:
+            self._mark_rejected(meme, detections=detections)
+            return reason
+        self._replace_crops(meme, crops)
+        return None
+
+    def refilter(self) -> None:
+        """Recreate crops of all processed memes with current filters without running OCR.
+
+        Only memes with stored detections can be refiltered. Memes rejected
+        by current filters are kept marked as rejected, so refiltering with
+        looser ones later revives them.
+        """
+        processed = Meme.ocr_status != OCR_PENDING
+        total = self._session.query(func.count(Meme.id)).filter(processed).scalar()
+        rejected = defaultdict(int)
+        for i, meme_id in enumerate(self._iter_ids(processed)):
+            meme = self._session.get(Meme, meme_id)
+            # Meme could be deleted along with a rejected original
+            if meme is None:
+                continue
+            reason = self.refilter_meme(meme)
+            if reason is not None:
+                rejected[reason] += 1
+            if (i + 1) % 1000 == 0:
+                print(f'[{i + 1}/{total}] refiltered')
+        print(f'[{total}/{total}] refiltered, rejected: {dict(rejected)}')
@@ -0,0 +1,106 @@
+import torch
+from multiprocessing import Pool
+from collections import deque
+from itertools import islice
+from typing import List, Tuple
+from ocr.cropper import Cropper, CropResult, CropFilters
+from database.engine import dispose_after_fork
+
+
+# Cropper of the current worker process
+_cropper = None
+
+
+def _init_worker(
+        torch_threads: int,
+        bucket_step: int,
+        max_side: int,
+        filters: CropFilters,
+        lazy_crops: bool,
+) -> None:
+    global _cropper
+    torch.set_num_threads(torch_threads)
+    # Connections inherited from the parent process can't be shared
+    dispose_after_fork()
+    _cropper = Cropper(
+        bucket_step=bucket_step,
+        max_side=max_side,
+        filters=filters,
+        lazy_crops=lazy_crops,
+    )
+    # Load reader model once per worker
+    _cropper.reader
+
+
+def _read_memes(params: Tuple[List[int], int]) -> List[CropResult]:
+    meme_ids, batch_size = params
+    return _cropper.read_memes(meme_ids, batch_size=batch_size)
+
+
+class ParallelCropper:
+    '''Runs OCR in worker processes while this process commits results.
+
+    Workers get chunks of uncropped meme ids, load pictures from the
+    database on their own and send back crops along with rejections.
+    '''
+
+    def __init__(
+            self,
+            workers: int = 4,
+            torch_threads: int = 1,
+            chunk_size: int = 16,
+            batch_size: int = None,
+            bucket_step: int = 128,
+            max_side: int = None,
+            filters: CropFilters = None,
+            delete_rejected: bool = False,
+            lazy_crops: bool = False,
+            chunks_in_flight: int = None,
+    ):
+        self._workers = workers
+        self._torch_threads = torch_threads
+        self._chunk_size = chunk_size
+        self._batch_size = batch_size
+        self._bucket_step = bucket_step
+        self._max_side = max_side
+        self._filters = filters
+        self._delete_rejected = delete_rejected
+        self._lazy_crops = lazy_crops
+        # Pool.imap would read all pending ids up front, so only a few
+        # chunks per worker are submitted at a time
+        self._chunks_in_flight = chunks_in_flight or 2 * workers
+
+    def crop(self) -> None:
+        # Reader is never loaded by the writer
+        writer = Cropper(delete_rejected=self._delete_rejected)
+        total = writer._count_pending()
+        ids = writer._iter_pending_ids()
+        # Pending ids are paged through as chunks are submitted
+        chunks = iter(lambda: (list(islice(ids, self._chunk_size)), self._batch_size),
+                      ([], self._batch_size))
+
+        done = 0
+        in_flight = deque()
+        with Pool(
+            processes=self._workers,
+            initializer=_init_worker,
+            initargs=(
+                self._torch_threads,
+                self._bucket_step,
+                self._max_side,
+                self._filters,
+                self._lazy_crops,
+            ),
+        ) as pool:
+            for chunk in chunks:
+                in_flight.append(pool.apply_async(_read_memes, (chunk,)))
+                if len(in_flight) >= self._chunks_in_flight:
+                    done = self._apply(writer, in_flight.popleft().get(), done, total)
+            while in_flight:
+                done = self._apply(writer, in_flight.popleft().get(), done, total)
+
+    def _apply(self, writer: Cropper, results: List[CropResult], done: int, total: int) -> int:
+        writer.apply_results(results)
+        done += len(results)
+        print(f'[{done}/{total}] cropped')
+        return done
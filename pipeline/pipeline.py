@@ -0,0 +1,92 @@
+import queue
+from threading import Thread
+from typing import Callable, Dict, List
+from scraper.asyncscraper import AsyncParallelScraper
+from scraper.parallelscraper import ScrapePlan
+from scraper.utils import StatDict
+from ocr.cropper import Cropper
+
+
+class Pipeline:
+    '''Streams freshly scraped memes straight into OCR.
+
+    Saved meme ids go through a bounded buffer to a worker thread that
+    crops them and commits crops as they are produced. A full buffer
+    blocks the scraper's writer, which in turn stops scrapers from
+    fetching more than OCR can keep up with.
+    '''
+
+    def __init__(
+            self,
+            buffer_size: int = 64,
+            cropper_factory: Callable[[], Cropper] = Cropper,
+            **scraper_params,
+    ):
+        self._buffer = queue.Queue(maxsize=buffer_size)
+        self._cropper_factory = cropper_factory
+        self._scraper = AsyncParallelScraper(on_saved=self._enqueue, **scraper_params)
+        self._error = None
+        self.n_cropped = 0
+
+    def _put(self, meme_id: int) -> None:
+        while True:
+            try:
+                self._buffer.put(meme_id, timeout=1)
+                return
+            except queue.Full:
+                # Don't wait forever on a worker that is gone
+                if self._error is not None:
+                    raise RuntimeError('OCR worker failed') from self._error
+
+    def _enqueue(self, meme_ids: List[int]) -> None:
+        for meme_id in meme_ids:
+            self._put(meme_id)
+
+    def _crop_worker(self) -> None:
+        try:
+            # Reader model is loaded in the worker thread
+            cropper = self._cropper_factory()
+            while True:
+                meme_id = self._buffer.get()
+                if meme_id is None:
+                    return
+                cropper.crop_meme_id(meme_id)
+                self.n_cropped += 1
+        except Exception as e:
+            self._error = e
+            raise
+
+    def run(
+            self,
+            scrape_plan: ScrapePlan,
+            incremental: bool = False,
+            print_report: bool = True,
+    ) -> Dict[str, StatDict]:
+        """Scrape publics according to plan and crop memes as they are saved.
+
+        Params:
+            scrape_plan: number of posts (and offset) to scan through for each public domain
+            incremental: only scrape posts newer than the last scraped ones
+            print_report: print scraped posts stats
+        Returns:
+            stats: scraped posts stats for each public domain
+        """
+        self._error = None
+        worker = Thread(target=self._crop_worker, daemon=True)
+        worker.start()
+        try:
+            stats = self._scraper.scrape(
+                scrape_plan, print_report=print_report, incremental=incremental
+            )
+        finally:
+            # Let the worker finish what is already buffered
+            try:
+                self._put(None)
+            except RuntimeError:
+                pass
+            worker.join()
+        if self._error is not None:
+            raise RuntimeError('OCR worker failed') from self._error
+        if print_report:
+            print(f'Cropped {self.n_cropped} memes')
+        return stats
@@ -0,0 +1,338 @@
+import asyncio
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from typing import Callable, Dict, List, Optional, Tuple
+from scraper.scraper import Scraper, LastPost
+from scraper.parallelscraper import ScrapePlan
+from database.utils import get_public
+from database.models import Post, Meme
+from scraper.ratelimit import RateLimiter
+from scraper.utils import print_stats, print_rate_stats, accumulate_stats, \
+    make_execute_code, StatDict, EXECUTE_MAX_CALLS
+
+
+VK_API_URL = 'https://api.vk.com/method/'
+
+# (domain, offset, count)
+Window = Tuple[str, int, int]
+
+
+class VkApiError(Exception):
+
+    def __init__(self, method: str, error: dict):
+        self.method = method
+        self.code = error.get('error_code')
+        self.error = error
+        super().__init__(f'[{self.code}] {method}: {error.get("error_msg")}')
+
+
+class AsyncVkApi:
+    '''Asyncio VK API client drawing calls from a shared rate limiter'''
+
+    def __init__(
+            self,
+            token: str,
+            session: aiohttp.ClientSession,
+            rate_limiter: RateLimiter,
+            api_version: str = '5.131',
+            retries: int = 5,
+            backoff: float = 1,
+    ):
+        self._token = token
+        self._session = session
+        self._rate_limiter = rate_limiter
+        self._api_version = api_version
+        self._retries = retries
+        self._backoff = backoff
+
+    async def method(self, method: str, **params) -> dict:
+        params.update(access_token=self._token, v=self._api_version)
+        for attempt in range(self._retries + 1):
+            await self._rate_limiter.acquire_async()
+            async with self._session.post(VK_API_URL + method, data=params) as r:
+                response = await r.json(content_type=None)
+            if 'error' not in response.keys():
+                return response['response']
+            # Only rate limit errors are worth waiting for
+            code = response['error']['error_code']
+            if code not in (6, 29):
+                raise VkApiError(method, response['error'])
+            if attempt == self._retries:
+                raise ConnectionRefusedError('API calls limit reached')
+            self._rate_limiter.penalize(self._backoff * 2 ** attempt)
+
+    async def wall_get(self, domain: str, offset: int = 0, count: int = 100) -> List[dict]:
+        response = await self.method('wall.get', domain=domain, offset=offset, count=count)
+        return response['items']
+
+    async def wall_get_many(self, windows: List[Window]) -> List[List[dict]]:
+        '''Fetches (domain, offset, count) windows packing up to 25 per `execute`'''
+        responses = []
+        for i in range(0, len(windows), EXECUTE_MAX_CALLS):
+            chunk = windows[i:i + EXECUTE_MAX_CALLS]
+            code = make_execute_code('wall.get', [
+                {'domain': d, 'offset': o, 'count': c} for d, o, c in chunk
+            ])
+            response = await self.method('execute', code=code)
+            for (d, o, c), r in zip(chunk, response):
+                # Calls that failed inside execute come back as false
+                if not r:
+                    responses.append(await self.wall_get(domain=d, offset=o, count=c))
+                else:
+                    responses.append(r['items'])
+        return responses
+
+
+class AsyncParallelScraper:
+    '''Scrapes all publics of a plan concurrently in a single event loop.
+
+    Every public shares one throttled VK API client and one connection pool
+    for picture downloads. Scraped posts are committed by a single writer
+    as soon as each window is parsed.
+    '''
+
+    def __init__(
+            self,
+            calls_per_second: float = 3,
+            burst: int = 1,
+            download_workers: int = 16,
+            download_timeout: float = 10,
+            download_retries: int = 3,
+            download_backoff: float = 0.5,
+            queue_size: int = 16,
+            use_execute: bool = False,
+            on_saved: Callable[[List[int]], None] = None,
+    ):
+        self._calls_per_second = calls_per_second
+        self._burst = burst
+        self._download_workers = download_workers
+        self._download_timeout = download_timeout
+        self._download_retries = download_retries
+        self._download_backoff = download_backoff
+        self._queue_size = queue_size
+        self._use_execute = use_execute
+        # Called from the writer thread with ids of every batch of saved memes
+        self._on_saved = on_saved
+
+    def _get_scrapers(self, scrape_plan: Dict[str, int]) -> List[Scraper]:
+        publics = [get_public(domain=d) for d in scrape_plan.keys()]
+        return [Scraper(p) for p in publics]
+
+    def _get_token(self, scraper: Scraper) -> str:
+        scraper._open_api_session()
+        return scraper.api_session.token['access_token']
+
+    async def _download_picture(
+            self,
+            http: aiohttp.ClientSession,
+            url: str
+    ) -> Optional[bytes]:
+        for attempt in range(self._download_retries + 1):
+            try:
+                async with http.get(url) as r:
+                    r.raise_for_status()
+                    return await r.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self._download_retries:
+                    return None
+                await asyncio.sleep(self._download_backoff * 2 ** attempt)
+
+    async def _process_window(
+            self,
+            scraper: Scraper,
+            response: List[dict],
+            http: aiohttp.ClientSession,
+            queue: asyncio.Queue,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        # Existing posts are looked up in the database
+        response = await loop.run_in_executor(None, scraper._filter_response, response)
+        posts, jobs = scraper._parse_response(response)
+        # Only download pictures that aren't stored yet
+        known = await loop.run_in_executor(None, scraper._find_known_pictures, jobs)
+        pictures = await asyncio.gather(*[
+            self._download_picture(http, url)
+            for url in scraper._get_download_urls(jobs, known)
+        ])
+        # Hashes pictures and looks them up in the database
+        memes = await loop.run_in_executor(
+            None, scraper._create_memes, posts, jobs, known, pictures
+        )
+        # Blocks when the writer falls behind
+        await queue.put((scraper, posts, memes, None))
+
+    async def _scrape_public(
+            self,
+            scraper: Scraper,
+            count: int,
+            offset: int,
+            api: AsyncVkApi,
+            http: aiohttp.ClientSession,
+            queue: asyncio.Queue,
+            responses: List[List[dict]] = None,
+    ) -> None:
+        offsets, counts = scraper._get_windows(offset=offset, count=count)
+        for i, (o, c) in enumerate(zip(offsets, counts)):
+            if responses is not None:
+                response = responses[i]
+            else:
+                response = await api.wall_get(domain=scraper._domain, offset=o, count=c)
+            await self._process_window(scraper, response, http, queue)
+
+    async def _scrape_public_incremental(
+            self,
+            scraper: Scraper,
+            max_count: int,
+            api: AsyncVkApi,
+            http: aiohttp.ClientSession,
+            queue: asyncio.Queue,
+    ) -> None:
+        last_post, complete = None, False
+        # Go from the newest posts until already scraped ones are reached
+        for offset in range(0, max_count, 100):
+            count = min(100, max_count - offset)
+            response = await api.wall_get(domain=scraper._domain, offset=offset, count=count)
+            last_post = scraper._get_last_post(response, last_post)
+            new, reached = scraper._split_new_posts(response)
+            complete = reached or len(response) < count
+            await self._process_window(scraper, new, http, queue)
+            if complete:
+                break
+        # Writer moves high-water mark after all new posts are saved
+        await queue.put((scraper, [], [], scraper._final_last_post(last_post, complete)))
+
+    async def _prefetch(
+            self,
+            api: AsyncVkApi,
+            scrapers: List[Scraper],
+            plans: List[Tuple[int, int]],
+    ) -> List[List[List[dict]]]:
+        # Windows of all publics are packed together into `execute` calls
+        windows = []
+        for scraper, (count, offset) in zip(scrapers, plans):
+            offsets, counts = scraper._get_windows(offset=offset, count=count)
+            windows.append([(scraper._domain, o, c) for o, c in zip(offsets, counts)])
+        flat = await api.wall_get_many([w for ws in windows for w in ws])
+        # Split responses back per public
+        responses, i = [], 0
+        for ws in windows:
+            responses.append(flat[i:i + len(ws)])
+            i += len(ws)
+        return responses
+
+    def _save(
+            self,
+            scraper: Scraper,
+            posts: List[Post],
+            memes: List[Meme],
+            last_post: LastPost = None,
+    ) -> StatDict:
+        pic_size = sum(map(lambda x: len(x.picture or b'') / 1e6, memes))
+        meme_ids = scraper.save_to_db(posts, memes)
+        scraper.save_last_post(last_post)
+        if self._on_saved is not None and meme_ids:
+            self._on_saved(meme_ids)
+        return {'n_posts': len(posts), 'n_pics': len(memes), 'size': pic_size}
+
+    async def _write(self, queue: asyncio.Queue, stats: Dict[str, StatDict]) -> None:
+        loop = asyncio.get_running_loop()
+        # Single thread keeps database writes sequential
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    queue.task_done()
+                    return
+                scraper, posts, memes, last_post = item
+                report = await loop.run_in_executor(
+                    writer, self._save, scraper, posts, memes, last_post
+                )
+                stats[scraper._domain] = accumulate_stats(stats[scraper._domain], report)
+                queue.task_done()
+
+    async def scrape_async(
+            self,
+            scrape_plan: ScrapePlan,
+            incremental: bool = False,
+    ) -> Dict[str, StatDict]:
+        loop = asyncio.get_running_loop()
+        scrapers = self._get_scrapers(scrape_plan)
+        # All publics share the same credentials, so authenticate once
+        token = await loop.run_in_executor(None, self._get_token, scrapers[0])
+
+        stats = {s._domain: {'n_posts': 0, 'n_pics': 0, 'size': 0} for s in scrapers}
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        connector = aiohttp.TCPConnector(limit=self._download_workers)
+        timeout = aiohttp.ClientTimeout(total=self._download_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+            rate_limiter = RateLimiter(self._calls_per_second, self._burst)
+            api = AsyncVkApi(token, http, rate_limiter)
+            plans = [self._unpack_plan(v) for v in scrape_plan.values()]
+            if incremental:
+                scraping = asyncio.gather(*[
+                    self._scrape_public_incremental(scraper, count, api, http, queue)
+                    for scraper, (count, _) in zip(scrapers, plans)
+                ])
+            else:
+                responses = [None] * len(scrapers)
+                if self._use_execute:
+                    responses = await self._prefetch(api, scrapers, plans)
+                scraping = asyncio.gather(*[
+                    self._scrape_public(scraper, count, offset, api, http, queue, r)
+                    for scraper, (count, offset), r in zip(scrapers, plans, responses)
+                ])
+            writer = asyncio.create_task(self._write(queue, stats))
+            try:
+                done, _ = await asyncio.wait(
+                    {scraping, writer}, return_when=asyncio.FIRST_COMPLETED
+                )
+                # Writer only stops before scrapers do on errors
+                if writer in done:
+                    scraping.cancel()
+                    writer.result()
+                await scraping
+            finally:
+                if not writer.done():
+                    await queue.put(None)
+                    await writer
+        self.rate_stats = rate_limiter.stats()
+        return stats
+
+    def _unpack_plan(self, plan_value) -> Tuple[int, int]:
+        # Plan values are either count or (count, offset)
+        if type(plan_value) is tuple:
+            return plan_value
+        return plan_value, 0
+
+    def scrape(
+            self,
+            scrape_plan: ScrapePlan,
+            print_report: bool = True,
+            incremental: bool = False,
+    ) -> Dict[str, StatDict]:
+        """Scrape publics according to plan.
+
+        Params:
+            scrape_plan: number of posts (and offset) to scan through for each public domain
+            print_report: print scraped posts stats
+            incremental: only scrape posts newer than the last scraped ones,
+                plan counts become maximum number of posts to scan through
+        Returns:
+            stats: scraped posts stats for each public domain
+        """
+        # Check if scrape plan post counts does not exceed max API calls
+        if sum(map(lambda x: self._unpack_plan(x)[0], scrape_plan.values())) > 50000:
+            raise ValueError('Scraping plan exceeds maximum allowed API calls')
+
+        stats = asyncio.run(self.scrape_async(scrape_plan, incremental=incremental))
+
+        # Print report
+        if print_report:
+            print()
+            for domain, stat in stats.items():
+                print_stats(domain, stat)
+            total_stats = reduce(accumulate_stats, [dict(s) for s in stats.values()])
+            print_stats('TOTAL', total_stats)
+            print_rate_stats(self.rate_stats)
+        return stats
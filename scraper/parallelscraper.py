@@ -4,22 +4,46 @@ from itertools import repeat
 from functools import reduce
 from scraper.scraper import Scraper
 from database.utils import get_public
-from database.engine import Session
-from scraper.utils import print_stats, accumulate_stats
+from database.engine import Session, dispose_after_fork
+from database.blobstore import store_pictures
+from database.bulk import insert_posts
+from scraper.ratelimit import RateLimiterManager
+from scraper.utils import print_stats, print_rate_stats, accumulate_stats, StatDict
 
 
 ScrapePlan = Union[Dict[str, Tuple[int, int]], Dict[str, int]]
 
 
+def _init_worker() -> None:
+    # Connections inherited from the parent process can't be shared
+    dispose_after_fork()
+
+
 class ParallelScraper:
 
-    def _get_scrapers(self, scrape_plan: Dict[str, int]) -> List[Scraper]:
+    def __init__(self, calls_per_second: float = 3, burst: int = 1, use_execute: bool = False):
+        self._calls_per_second = calls_per_second
+        self._burst = burst
+        # Packs the windows of a batch into `execute` calls, so it pays off
+        # with batch sizes over 100
+        self._use_execute = use_execute
+
+    def _get_scrapers(self, scrape_plan: Dict[str, int], rate_limiter=None) -> List[Scraper]:
         publics = [get_public(domain=d) for d in scrape_plan.keys()]
-        return [Scraper(p) for p in publics]
+        scrapers = [Scraper(p, rate_limiter=rate_limiter) for p in publics]
+        # Load existing posts once, workers get them with pickled scrapers
+        for scraper in scrapers:
+            scraper.load_existing_posts()
+        return scrapers
 
     def _pool_func(self, params: Tuple[Scraper, int, int]):
         scraper, count, offset = params
-        return scraper.scrape_return(offset=offset, count=count, print_report=False)
+        return scraper.scrape_return(offset=offset, count=count, print_report=False,
+                                     use_execute=self._use_execute)
+
+    def _pool_func_incremental(self, params: Tuple[Scraper, int]):
+        scraper, max_count = params
+        return scraper.scrape_incremental_return(max_count=max_count, print_report=False)
 
     def _update_scrape_plan(self, scrape_plan: ScrapePlan, batch: int = 100) -> ScrapePlan:
         # Add counts as offsets to scrape plan
@@ -37,21 +61,78 @@ class ParallelScraper:
 
         return scrape_plan
 
-    def scrape(self, scrape_plan: Dict[str, int], batch_size: int = 100) -> None:
+    def scrape(
+            self,
+            scrape_plan: Dict[str, int],
+            batch_size: int = 100,
+            incremental: bool = False,
+    ) -> None:
+        """Scrape publics according to plan.
+
+        Params:
+            scrape_plan: number of posts to scan through for each public domain
+            batch_size: number of posts per public to scrape between commits
+            incremental: only scrape posts newer than the last scraped ones,
+                plan counts become maximum number of posts to scan through
+        """
         # Check if scrape plan post counts does not exceed max API calls
         if sum(scrape_plan.values()) > 50000:
             raise ValueError('Scraping plan exceeds maximum allowed API calls')
 
-        # Get Scraper instance for each public
-        scrapers = self._get_scrapers(scrape_plan)
+        # Every scraper process draws API calls from the same limiter
+        with RateLimiterManager() as manager:
+            rate_limiter = manager.RateLimiter(self._calls_per_second, self._burst)
+            # Get Scraper instance for each public
+            scrapers = self._get_scrapers(scrape_plan, rate_limiter=rate_limiter)
+            if incremental:
+                stats = self._scrape_incremental(scrape_plan, scrapers)
+            else:
+                stats = self._scrape_batches(scrape_plan, scrapers, batch_size)
+            rate_stats = rate_limiter.stats()
+
+        # Print report
+        print()
+        for domain, stat in zip(scrape_plan.keys(), stats):
+            print_stats(domain, stat)
+        total_stats = reduce(accumulate_stats, stats)
+        print_stats('TOTAL', total_stats)
+        print_rate_stats(rate_stats)
+
+    def _scrape_incremental(
+            self,
+            scrape_plan: Dict[str, int],
+            scrapers: List[Scraper],
+    ) -> List[StatDict]:
+        with Pool(processes=len(scrapers), initializer=_init_worker) as pool:
+            map_return = pool.map(
+                self._pool_func_incremental,
+                zip(scrapers, scrape_plan.values())
+            )
+        # Parse map_return List[Tuple[StatDict, List[Post], List[Meme], LastPost]]
+        stats = [r[0] for r in map_return]
+        with Session() as session:
+            for _, p, m, _ in map_return:
+                store_pictures(m)
+                insert_posts(session, p, m)
+            session.commit()
+        # Move high-water marks only after new posts are saved
+        for scraper, (_, _, _, last_post) in zip(scrapers, map_return):
+            scraper.save_last_post(last_post)
+        return stats
 
+    def _scrape_batches(
+            self,
+            scrape_plan: ScrapePlan,
+            scrapers: List[Scraper],
+            batch_size: int = 100
+    ) -> List[StatDict]:
         stats = []
         # "Batch-process" data so that we can commit every n posts
         while any(map(lambda x: type(x) is int or x[1] != 0, scrape_plan.values())):
             # Update scrape_plan
             scrape_plan = self._update_scrape_plan(scrape_plan, batch=batch_size)
             # Scrape using multiprocessing
-            with Pool(processes=len(scrapers)) as pool:
+            with Pool(processes=len(scrapers), initializer=_init_worker) as pool:
                 map_return = pool.map(
                     self._pool_func,
                     zip(
@@ -71,15 +152,13 @@ class ParallelScraper:
             # Parse posts and memes
             posts = [r[1] for r in map_return]
             memes = [r[2] for r in map_return]
-            # Commit data
+            # Workers' updates of existing posts are lost with their copies
+            for scraper, p in zip(scrapers, posts):
+                scraper.add_existing_posts(p)
+            # Commit data of all publics in one transaction
             with Session() as session:
                 for p, m in zip(posts, memes):
-                    session.add_all(p)
-                    session.add_all(p)
-                    session.commit()
-        # Print report
-        print()
-        for domain, stat in zip(scrape_plan.keys(), stats):
-            print_stats(domain, stat)
-        total_stats = reduce(accumulate_stats, stats)
-        print_stats('TOTAL', total_stats)
+                    store_pictures(m)
+                    insert_posts(session, p, m)
+                session.commit()
+        return stats
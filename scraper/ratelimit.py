@@ -0,0 +1,73 @@
+import time
+import asyncio
+from threading import Lock
+from multiprocess.managers import BaseManager
+from scraper.utils import RateStatDict
+
+
+class RateLimiter:
+    '''Token bucket that keeps API calls under a number of calls per second.
+
+    Callers reserve a token and wait for it instead of failing, so a
+    limiter shared by several scrapers spreads one budget between them.
+    '''
+
+    def __init__(self, calls_per_second: float = 3, burst: int = 1):
+        self._rate = calls_per_second
+        self._burst = burst
+        self._tokens = burst
+        self._lock = Lock()
+        self._started = time.monotonic()
+        self._updated = self._started
+        self._calls = 0
+        self._total_wait = 0.
+        self._max_wait = 0.
+
+    def reserve(self) -> float:
+        '''Takes a token and returns how long to wait before using it'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(0., -self._tokens / self._rate)
+            # Update metrics
+            self._calls += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        return wait
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def penalize(self, delay: float) -> None:
+        '''Delays every following call by at least `delay` seconds'''
+        with self._lock:
+            self._tokens = min(self._tokens, -delay * self._rate)
+
+    def stats(self) -> RateStatDict:
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                'calls': self._calls,
+                'throughput': self._calls / elapsed if elapsed > 0 else 0.,
+                'total_wait': self._total_wait,
+                'mean_wait': self._total_wait / self._calls if self._calls else 0.,
+                'max_wait': self._max_wait,
+            }
+
+
+class RateLimiterManager(BaseManager):
+    '''Serves a RateLimiter shared by scrapers in different processes'''
+
+
+RateLimiterManager.register('RateLimiter', RateLimiter)
@@ -1,22 +1,56 @@
 import vk_api
 import requests
+import time
 from os import environ
 from datetime import datetime
-from typing import Tuple, List
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Dict, Optional, Callable
 from database.models import Public, Post, Meme
 from database.engine import Session
-from scraper.utils import print_stats, accumulate_stats, StatDict
+from database.blobstore import store_pictures, content_hash
+from database.bulk import insert_posts
+from database.utils import set_last_post
+from scraper.utils import print_stats, accumulate_stats, make_http_session, \
+    make_execute_code, dhash, StatDict, EXECUTE_MAX_CALLS
+from scraper.ratelimit import RateLimiter
+
+
+# (post, picture index in post, picture url, VK photo key)
+PictureJob = Tuple[Post, Optional[int], str, str]
+# (post id, post date) of the newest post seen
+LastPost = Tuple[int, str]
 
 
 class Scraper:
 
-    def __init__(self, public: Public, app_id: str = None, login: str = None, password: str = None):
+    def __init__(
+            self,
+            public: Public,
+            app_id: str = None,
+            login: str = None,
+            password: str = None,
+            download_workers: int = 8,
+            download_timeout: float = 10,
+            download_retries: int = 3,
+            download_backoff: float = 0.5,
+            rate_limiter: RateLimiter = None,
+            api_retries: int = 5,
+            api_backoff: float = 1,
+    ):
         self.public = public
         self._domain = public.domain
         self._owner_id = public.id
         self._app_id = environ['VKAPI_APP_ID'] if app_id is None else app_id
         self._login = environ['VKAPI_LOGIN'] if login is None else login
         self._password = environ['VKAPI_PASSWORD'] if password is None else password
+        self._download_workers = download_workers
+        self._download_timeout = download_timeout
+        self._download_retries = download_retries
+        self._download_backoff = download_backoff
+        self._rate_limiter = rate_limiter
+        self._api_retries = api_retries
+        self._api_backoff = api_backoff
 
     def _open_api_session(self) -> None:
         self.api_session = vk_api.VkApi(
@@ -30,14 +64,58 @@ class Scraper:
         # self.api = vk_api.API(self.api_session, v='5.131', lang='ru', timeout=10)
         self.api = self.api_session.get_api()
 
+    def _open_http_session(self) -> None:
+        self.http = make_http_session(
+            pool_size=self._download_workers,
+            retries=self._download_retries,
+            backoff=self._download_backoff,
+        )
+
+    def _call_api(self, method: Callable, **params) -> dict:
+        for attempt in range(self._api_retries + 1):
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            try:
+                return method(**params)
+            except vk_api.exceptions.ApiError as e:
+                # Only rate limit errors are worth waiting for
+                if e.code not in (6, 29):
+                    raise
+                if attempt == self._api_retries:
+                    raise ConnectionRefusedError('API calls limit reached') from e
+                delay = self._api_backoff * 2 ** attempt
+                if self._rate_limiter is not None:
+                    self._rate_limiter.penalize(delay)
+                else:
+                    time.sleep(delay)
+
     def _request(self, offset: int = 0, count: int = 100) -> dict:
-        response = self.api.wall.get(domain=self._domain, count=count,
-                                 offset=offset)
-        if 'error' in response.keys():
-            if response['error']['error_code'] == 29:
-                raise ConnectionRefusedError('API calls limit reached')
+        response = self._call_api(self.api.wall.get, domain=self._domain,
+                                  count=count, offset=offset)
         return response['items']
 
+    def _request_many(self, windows: List[Tuple[int, int]]) -> List[List[dict]]:
+        responses = []
+        for i in range(0, len(windows), EXECUTE_MAX_CALLS):
+            chunk = windows[i:i + EXECUTE_MAX_CALLS]
+            code = make_execute_code('wall.get', [
+                {'domain': self._domain, 'offset': o, 'count': c} for o, c in chunk
+            ])
+            response = self._call_api(self.api.execute, code=code)
+            for (o, c), r in zip(chunk, response):
+                # Calls that failed inside execute come back as false
+                if not r:
+                    r = {'items': self._request(offset=o, count=c)}
+                responses.append(r['items'])
+        return responses
+
+    def _get_windows(self, offset: int = 0, count: int = 100) -> Tuple[List[int], List[int]]:
+        # Windows go from the oldest posts to the newest ones
+        offsets = range(count + offset - 100, offset - 100, -100)
+        counts = [100 + min(o, 0) for o in offsets]
+        offsets = list(map(lambda x: max(x, 0), offsets))
+        return offsets, counts
+
     def _to_datetime_string(self, ts: datetime) -> str:
         return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
 
@@ -47,47 +125,100 @@ class Scraper:
         return sizes[0]['url']
 
     def _download_picture(self, url: str) -> bytes:
-        img_data = requests.get(url).content
-        return img_data
+        response = self.http.get(url, timeout=self._download_timeout)
+        response.raise_for_status()
+        return response.content
+
+    def _try_download_picture(self, url: str) -> Optional[bytes]:
+        try:
+            return self._download_picture(url)
+        except requests.RequestException:
+            return None
+
+    def _download_pictures(self, urls: List[str]) -> List[Optional[bytes]]:
+        if not urls:
+            return []
+        # Establish http session if it hasn't yet
+        if not hasattr(self, 'http'):
+            self._open_http_session()
+        # Download concurrently, results keep the order of urls
+        workers = min(self._download_workers, len(urls))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self._try_download_picture, urls))
+
+    def _split_new_posts(self, response: List[dict]) -> Tuple[List[dict], bool]:
+        last_post_id = self.public.last_post_id
+        if last_post_id is None:
+            return response, False
+        new = [p for p in response if p['id'] > last_post_id]
+        # Pinned posts are shown first regardless of their age
+        reached = any(p['id'] <= last_post_id for p in response if not p.get('is_pinned'))
+        return new, reached
+
+    def _get_last_post(self, response: List[dict], last_post: LastPost = None) -> LastPost:
+        newest = max(response, key=lambda x: x['id'], default=None)
+        if newest is None or (last_post is not None and last_post[0] >= newest['id']):
+            return last_post
+        return newest['id'], self._to_datetime_string(newest['date'])
+
+    def _final_last_post(self, last_post: LastPost, complete: bool) -> LastPost:
+        # If max_count ran out before scraped posts were reached, moving the mark
+        # would skip posts between them for good, so it stays for the next run
+        if complete or self.public.last_post_id is None:
+            return last_post
+        return None
+
+    def save_last_post(self, last_post: LastPost) -> None:
+        if last_post is None:
+            return
+        set_last_post(self._owner_id, *last_post)
+        self.public.last_post_id, self.public.last_post_date = last_post
+
+    def load_existing_posts(self) -> None:
+        '''Loads ids of public's posts already stored in the database'''
+        with Session() as session:
+            post_ids = session.query(Post.id) \
+                            .filter(Post.public_id == self._owner_id) \
+                            .all()
+        self._existing_posts = set(map(lambda x: int(x[0]), post_ids))
+
+    def add_existing_posts(self, posts: List[Post]) -> None:
+        self._existing_posts.update(map(lambda x: int(x.id), posts))
 
     def _filter_response(self, response: dict) -> dict:
         if not hasattr(self, '_existing_posts'):
-            with Session() as session:
-                post_ids = session.query(Post.id) \
-                                .filter(Post.public == self.public) \
-                                .all()
-                self.existing_posts = set(map(lambda x: int(x[0]), post_ids))
-
-        ids = [p['id'] for p in response]
-        filtered_ids = list(filter(lambda x: x not in self.existing_posts, ids))
-        filtered = [p for p in response if p['id'] in filtered_ids]
+            self.load_existing_posts()
+
+        filtered = [p for p in response if int(p['id']) not in self._existing_posts]
+        # Later windows of the run shouldn't pick these posts up again
+        self._existing_posts.update(map(lambda x: int(x['id']), filtered))
         return filtered
 
-    def _parse_posts(
+    def _parse_response(
             self,
             response: dict,
-    ) -> Tuple[List[Post], List[Meme]]:
+    ) -> Tuple[List[Post], List[PictureJob]]:
         posts = []
-        memes = []
+        # (post, picture index, url, photo key) for every picture to download
+        jobs = []
 
-        for i, p in enumerate(response):
-            print(f'{self._domain} {p["id"]}:', end=' ')
+        for p in response:
             # Skip sponsored posts
             if p['marked_as_ads'] == 1:
-                print('[X]')
+                print(f'{self._domain} {p["id"]}: [X]')
                 continue
             # Skip posts without attachments
             if 'attachments' not in p.keys():
-                print('[X]')
+                print(f'{self._domain} {p["id"]}: [X]')
                 continue
             # Also skip posts without photos
             if all(map(lambda x: x['type'] != 'photo', p['attachments'])):
-                print('[X]')
+                print(f'{self._domain} {p["id"]}: [X]')
                 continue
 
             # Create new post
             post = Post(
-                public=self.public,
+                public_id=self._owner_id,
                 id=p['id'],
                 date=self._to_datetime_string(p['date']),
                 text=p['text'],
@@ -97,25 +228,117 @@ class Scraper:
                 views=p['views']['count']
             )
             posts.append(post)
-            print('[POST]', end=' ')
 
-            # Parse and download pictures
+            # Parse pictures urls
             pics_urls = [x['photo'] for x in p['attachments'] if x['type'] == 'photo']
             for i, urls in enumerate(pics_urls):
-                biggest_url = self._get_biggest_pic_url(urls)
-                try:
-                    picture = self._download_picture(biggest_url)
-                except:
-                    print('[X]')
-                    break
-                meme = Meme(
-                    post=post,
-                    index=i if len(pics_urls) > 1 else None,
-                    picture=picture
-                )
-                memes.append(meme)
-                print('[PIC]', end=' ')
-            print()
+                index = i if len(pics_urls) > 1 else None
+                key = f'{urls["owner_id"]}_{urls["id"]}'
+                jobs.append((post, index, self._get_biggest_pic_url(urls), key))
+        return posts, jobs
+
+    def _hash_picture(self, picture: Optional[bytes]) -> Optional[str]:
+        if picture is None:
+            return None
+        try:
+            return dhash(picture)
+        except OSError:
+            return None
+
+    def _find_memes(self, column, values: List[str]) -> Dict[str, int]:
+        # Maps values of column to ids of memes that own their pictures
+        if not values:
+            return {}
+        with Session() as session:
+            rows = session.query(column, Meme.id, Meme.duplicate_of) \
+                          .filter(column.in_(set(values))) \
+                          .all()
+        return {v: i if d is None else d for v, i, d in rows}
+
+    def _find_similar(self, phashes: List[str]) -> Dict[str, List[Tuple[int, Optional[str]]]]:
+        # Maps perceptual hashes to ids and content hashes of memes that own their pictures
+        if not phashes:
+            return {}
+        with Session() as session:
+            rows = session.query(Meme.phash, Meme.id, Meme.picture_hash) \
+                          .filter(Meme.phash.in_(set(phashes)), Meme.duplicate_of.is_(None)) \
+                          .order_by(Meme.id) \
+                          .all()
+        similar = {}
+        for phash, meme_id, picture_hash in rows:
+            similar.setdefault(phash, []).append((meme_id, picture_hash))
+        return similar
+
+    def _find_known_pictures(self, jobs: List[PictureJob]) -> Dict[str, int]:
+        return self._find_memes(Meme.photo_key, [key for _, _, _, key in jobs])
+
+    def _get_download_urls(self, jobs: List[PictureJob], known: Dict[str, int]) -> List[str]:
+        return [url for _, _, url, key in jobs if key not in known]
+
+    def _create_memes(
+            self,
+            posts: List[Post],
+            jobs: List[PictureJob],
+            known: Dict[str, int],
+            pictures: List[Optional[bytes]],
+    ) -> List[Meme]:
+        # Downloaded pictures may still be reposts under another photo id
+        hashes = list(map(self._hash_picture, pictures))
+        digests = [content_hash(p) if p is not None else None for p in pictures]
+        # Flat pictures all hash to zeros, so they aren't matched
+        similar = self._find_similar([h for h in hashes if h and h.strip('0')])
+        downloaded = iter(zip(pictures, hashes, digests))
+
+        memes = []
+        reports = {post.id: '[POST]' for post in posts}
+        failed = set()
+        for post, index, _, key in jobs:
+            picture, phash, digest = None, None, None
+            if key not in known:
+                picture, phash, digest = next(downloaded)
+            # Drop the rest of post's pictures after a failed download
+            if post.id in failed:
+                continue
+            # Pictures that can't be decoded count as failed downloads
+            if key not in known and phash is None:
+                failed.add(post.id)
+                reports[post.id] += ' [X]'
+                continue
+            meme = Meme(
+                post=post,
+                index=index,
+                photo_key=key,
+                phash=phash
+            )
+            # Duplicates refer to the picture that is already stored. The same
+            # template with other captions has the same perceptual hash, so
+            # only pictures with the same content are duplicates
+            duplicate_of = known.get(key)
+            if duplicate_of is None and phash in similar:
+                owners = similar[phash]
+                duplicate_of = next((i for i, h in owners if h == digest), None)
+                if duplicate_of is None:
+                    meme.similar_to = owners[0][0]
+            if duplicate_of is not None:
+                meme.duplicate_of = duplicate_of
+                reports[post.id] += ' [DUP]'
+            else:
+                meme.picture = picture
+                reports[post.id] += ' [PIC]'
+            memes.append(meme)
+        for post_id, report in reports.items():
+            print(f'{self._domain} {post_id}: {report}')
+        return memes
+
+    def _parse_posts(
+            self,
+            response: dict,
+    ) -> Tuple[List[Post], List[Meme]]:
+        posts, jobs = self._parse_response(response)
+        # Only download pictures that aren't stored yet
+        known = self._find_known_pictures(jobs)
+        pictures = self._download_pictures(self._get_download_urls(jobs, known))
+        memes = self._create_memes(posts, jobs, known, pictures)
         return posts, memes
 
     def save_to_db(
@@ -123,15 +346,17 @@ class Scraper:
             posts: List[Post],
             memes: List[Meme],
             session: Session = None,
-    ) -> None:
+    ) -> List[int]:
+        '''Saves posts and memes, returns ids of saved memes'''
         shared_session = session is not None
 
         session = Session() if not shared_session else session
-        session.add_all(posts)
-        session.add_all(memes)
+        store_pictures(memes)
+        meme_ids = insert_posts(session, posts, memes)
         if not shared_session:
             session.commit()
             session.close()
+        return meme_ids
 
     def _scrape_pipeline(
             self,
@@ -139,12 +364,14 @@ class Scraper:
             count: int = 100,
             limit: int = 100,
             commit: bool = True,
+            response: List[dict] = None,
     ) -> StatDict:
-        response = self._request(offset=offset, count=count)
+        if response is None:
+            response = self._request(offset=offset, count=count)
         response = self._filter_response(response)
         posts, memes = self._parse_posts(response)
         # Create report dict
-        pic_size = sum(map(lambda x: len(x.picture) / 1e6, memes))
+        pic_size = sum(map(lambda x: len(x.picture or b'') / 1e6, memes))
         stats = {'n_posts': len(posts), 'n_pics': len(memes), 'size': pic_size}
         if commit:
             self.save_to_db(posts, memes)
@@ -155,24 +382,29 @@ class Scraper:
             self,
             offset: int = 0,
             count: int = 100,
-            print_report: bool = True
+            print_report: bool = True,
+            use_execute: bool = False,
     ) -> StatDict:
         # Establish api session if it hasn't yet
         if not hasattr(self, 'api'):
             self._open_api_session()
 
         # Split requests into batches of maximum 100 posts
-        offsets = range(count + offset - 100, offset - 100, -100)
-        counts = [100 + min(o, 0) for o in offsets]
-        offsets = list(map(lambda x: max(x, 0), offsets))
+        offsets, counts = self._get_windows(offset=offset, count=count)
+        # Fetch all batches up front, packing up to 25 of them per request
+        if use_execute:
+            responses = self._request_many(list(zip(offsets, counts)))
+        else:
+            responses = repeat(None)
 
         stats = {'n_posts': 0, 'n_pics': 0, 'size': 0}
-        # Scrape one request at a time
-        for o, c in zip(offsets, counts):
+        # Process one request at a time
+        for o, c, r in zip(offsets, counts, responses):
             report = self._scrape_pipeline(
                 offset=o,
                 count=c,
-                limit=count
+                limit=count,
+                response=r
             )
             stats = accumulate_stats(stats, report)
 
@@ -186,26 +418,31 @@ class Scraper:
             self,
             offset: int = 0,
             count: int = 100,
-            print_report: bool = True
+            print_report: bool = True,
+            use_execute: bool = False,
     ) -> Tuple[StatDict, Post, Meme]:
         # Establish api session if it hasn't yet
         if not hasattr(self, 'api'):
             self._open_api_session()
 
         # Split requests into batches of maximum 100 posts
-        offsets = range(count + offset - 100, offset - 100, -100)
-        counts = [100 + min(o, 0) for o in offsets]
-        offsets = list(map(lambda x: max(x, 0), offsets))
+        offsets, counts = self._get_windows(offset=offset, count=count)
+        # Fetch all batches up front, packing up to 25 of them per request
+        if use_execute:
+            responses = self._request_many(list(zip(offsets, counts)))
+        else:
+            responses = repeat(None)
 
         stats = {'n_posts': 0, 'n_pics': 0, 'size': 0}
         posts, memes = [], []
-        # Scrape one request at a time
-        for o, c in zip(offsets, counts):
+        # Process one request at a time
+        for o, c, r in zip(offsets, counts, responses):
             report, p, m = self._scrape_pipeline(
                 offset=o,
                 count=c,
                 limit=count,
-                commit=False
+                commit=False,
+                response=r
             )
             stats = accumulate_stats(stats, report)
             posts.extend(p)
@@ -216,3 +453,65 @@ class Scraper:
             print_stats(self._domain, stats)
 
         return stats, posts, memes
+
+    def _scrape_incremental(
+            self,
+            max_count: int = 1000,
+    ) -> Tuple[StatDict, List[Post], List[Meme], LastPost]:
+        # Establish api session if it hasn't yet
+        if not hasattr(self, 'api'):
+            self._open_api_session()
+
+        stats = {'n_posts': 0, 'n_pics': 0, 'size': 0}
+        posts, memes = [], []
+        last_post, complete = None, False
+        # Go from the newest posts until already scraped ones are reached
+        for offset in range(0, max_count, 100):
+            count = min(100, max_count - offset)
+            response = self._request(offset=offset, count=count)
+            last_post = self._get_last_post(response, last_post)
+            new, reached = self._split_new_posts(response)
+            complete = reached or len(response) < count
+            report, p, m = self._scrape_pipeline(
+                offset=offset,
+                count=count,
+                limit=max_count,
+                commit=False,
+                response=new
+            )
+            stats = accumulate_stats(stats, report)
+            posts.extend(p)
+            memes.extend(m)
+            if complete:
+                break
+        return stats, posts, memes, self._final_last_post(last_post, complete)
+
+    def scrape_incremental(
+            self,
+            max_count: int = 1000,
+            print_report: bool = True,
+    ) -> StatDict:
+        '''Scrapes posts newer than the last scraped one, but no more than max_count'''
+        stats, posts, memes, last_post = self._scrape_incremental(max_count=max_count)
+        self.save_to_db(posts, memes)
+        # Move high-water mark only after new posts are saved
+        self.save_last_post(last_post)
+
+        # Print report
+        if print_report:
+            print_stats(self._domain, stats)
+
+        return stats
+
+    def scrape_incremental_return(
+            self,
+            max_count: int = 1000,
+            print_report: bool = True,
+    ) -> Tuple[StatDict, List[Post], List[Meme], LastPost]:
+        stats, posts, memes, last_post = self._scrape_incremental(max_count=max_count)
+
+        # Print report
+        if print_report:
+            print_stats(self._domain, stats)
+
+        return stats, posts, memes, last_post
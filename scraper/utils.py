@@ -1,7 +1,17 @@
-from typing import Dict, Union
+import json
+import requests
+from io import BytesIO
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, List, Union
 
 
 StatDict = Dict[str, Union[int, float]]
+RateStatDict = Dict[str, Union[int, float]]
+
+# VK allows at most 25 API calls inside one `execute`
+EXECUTE_MAX_CALLS = 25
 
 
 def print_stats(domain: str, stat: StatDict) -> None:
@@ -11,7 +21,58 @@ def print_stats(domain: str, stat: StatDict) -> None:
     ))
 
 
+def print_rate_stats(stat: RateStatDict) -> None:
+    print((
+            f'API: {stat["calls"]} calls ({stat["throughput"]:.2f}/s), '
+            f'waited {stat["total_wait"]:.1f}s '
+            f'(mean {stat["mean_wait"]:.2f}s, max {stat["max_wait"]:.2f}s)'
+    ))
+
+
 def accumulate_stats(a: StatDict, b: StatDict) -> StatDict:
     for key in a.keys():
         a[key] += b[key]
     return a
+
+
+def make_http_session(
+        pool_size: int = 10,
+        retries: int = 3,
+        backoff: float = 0.5,
+) -> requests.Session:
+    '''Returns keep-alive session that retries failed requests with backoff'''
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def make_execute_code(method: str, calls: List[dict]) -> str:
+    '''Returns VKScript that calls `method` once per params dict and returns all results'''
+    if len(calls) > EXECUTE_MAX_CALLS:
+        raise ValueError(f'execute allows at most {EXECUTE_MAX_CALLS} calls')
+    calls = ','.join(f'API.{method}({json.dumps(c, ensure_ascii=False)})' for c in calls)
+    return f'return [{calls}];'
+
+
+def dhash(picture: bytes, size: int = 8) -> str:
+    '''Returns perceptual difference hash of a picture as a hex string'''
+    image = Image.open(BytesIO(picture)).convert('L').resize((size + 1, size), Image.BILINEAR)
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f'{bits:0{size * size // 4}x}'